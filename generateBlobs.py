@@ -0,0 +1,202 @@
+"""
+This file generates synthetic GPR radargrams with YOLO labels, a NumPy port of generateBlobs.txt.
+Radargrams have a depth gradient, noise, Gaussian blobs, hyperbolas of point targets and line artifacts,
+and are rendered with the jet colormap. Images and labels are written by parallel processes as they are made.
+
+Output: <output>/images/000000.png, <output>/labels/000000.txt (class x_center y_center width height,
+normalized) and <output>/data.yaml with the class names.
+
+Example: python generateBlobs.py --count 20000 --output synthetic --workers 8
+"""
+
+from multiprocessing import Pool
+
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import cv2
+
+from utils.colormap import jet_lut, apply_colormap
+
+CLASSES = ['blob', 'hyperbola']
+
+
+# Settings of the radargrams, defaults are the values of generateBlobs.txt
+class Settings:
+    TIME_SAMPLES = 500  # rows
+    DISTANCE_SAMPLES = 700  # columns
+    GRADIENT = (0.05, 0.1)  # background from the left to the right border
+    NOISE = 1.0  # standard deviation of the Gaussian noise
+    BLOBS = (1, 8)  # number of blobs
+    BLOB_AMPLITUDE = 5.0
+    BLOB_ROW = (100, 400)  # blob center
+    BLOB_COLUMN = (50, 650)
+    BLOB_SIGMA_ROW = (10, 160)
+    BLOB_SIGMA_COLUMN = (15, 100)
+    BLOB_WINDOW = 4.0  # blobs are evaluated within this many sigmas of the center
+    BLOB_LABEL = 2.0  # labelled box in sigmas, the blob stands out of the noise within it
+    HYPERBOLAS = (0, 3)  # number of hyperbolas
+    HYPERBOLA_APEX_ROW = (40, 300)
+    HYPERBOLA_VELOCITY = (0.5, 2.0)  # columns per row of travel time, flatter hyperbolas for higher values
+    HYPERBOLA_HALF_WIDTH = (40, 150)  # columns on each side of the apex
+    HYPERBOLA_AMPLITUDE = (2.0, 5.0)
+    HYPERBOLA_THICKNESS = 3.0  # rows, standard deviation of the wavelet around the curve
+    LINES = 5  # horizontal line artifacts
+    LINE_LENGTH = (100, 200)
+    LINE_INTENSITY = (1, 3)
+    SIZE = None  # (width, height) of the written images, None - one pixel per sample
+
+
+# Adds an axis-aligned Gaussian blob to data, only within BLOB_WINDOW sigmas of its center.
+# The blob is separable, so it is the outer product of two 1D Gaussians. Returns the labelled box
+def add_blob(data, row, column, sigma_row, sigma_column, amplitude, settings):
+    rows, columns = data.shape
+    top = max(0, int(row - settings.BLOB_WINDOW * sigma_row))
+    bottom = min(rows, int(row + settings.BLOB_WINDOW * sigma_row) + 1)
+    left = max(0, int(column - settings.BLOB_WINDOW * sigma_column))
+    right = min(columns, int(column + settings.BLOB_WINDOW * sigma_column) + 1)
+
+    along_rows = np.exp(-(np.arange(top, bottom) - row) ** 2 / (2 * sigma_row ** 2))
+    along_columns = np.exp(-(np.arange(left, right) - column) ** 2 / (2 * sigma_column ** 2))
+    data[top:bottom, left:right] += amplitude * np.outer(along_rows, along_columns)
+
+    return (column - settings.BLOB_LABEL * sigma_column, row - settings.BLOB_LABEL * sigma_row,
+            column + settings.BLOB_LABEL * sigma_column, row + settings.BLOB_LABEL * sigma_row)
+
+
+# Adds the hyperbola a point target leaves in a B-scan: travel time sqrt(apex^2 + (offset / velocity)^2),
+# drawn as a Ricker-like wavelet around the curve within half_width columns of the apex. Returns the box
+def add_hyperbola(data, apex_row, apex_column, velocity, half_width, amplitude, settings):
+    rows, columns = data.shape
+    left, right = max(0, apex_column - half_width), min(columns, apex_column + half_width + 1)
+    offsets = np.arange(left, right) - apex_column
+    curve = np.sqrt(apex_row ** 2 + (offsets / velocity) ** 2)  # row of the reflection in every column
+
+    # Only the band of rows the wavelet reaches is evaluated
+    thickness = settings.HYPERBOLA_THICKNESS
+    top, bottom = max(0, int(apex_row - 4 * thickness)), min(rows, int(curve.max() + 4 * thickness) + 1)
+    if top >= bottom:
+        return None
+    distance = (np.arange(top, bottom)[:, None] - curve[None, :]) / thickness
+    wavelet = (1 - distance ** 2) * np.exp(-distance ** 2 / 2)
+    data[top:bottom, left:right] += amplitude * wavelet
+
+    return left, apex_row - 2 * thickness, right - 1, curve.max() + 2 * thickness
+
+
+# Adds horizontal line artifacts, clipped at the right border
+def add_lines(data, rng, settings):
+    rows, columns = data.shape
+    for _ in range(settings.LINES):
+        start_column = rng.integers(10, columns - 100, endpoint=True)
+        row = rng.integers(10, min(400, rows - 1), endpoint=True)
+        length = rng.integers(*settings.LINE_LENGTH, endpoint=True)
+        data[row, start_column:start_column + length + 1] += rng.integers(*settings.LINE_INTENSITY, endpoint=True)
+
+
+# Generates one radargram, returns the data and labels (class id, x1, y1, x2, y2) in samples
+def generate(rng, settings):
+    rows, columns = settings.TIME_SAMPLES, settings.DISTANCE_SAMPLES
+    data = rng.standard_normal((rows, columns)) * settings.NOISE
+    data += np.linspace(*settings.GRADIENT, columns)[None, :]
+
+    # generateBlobs.txt also adds a random constant per blob to the whole image, which does not change
+    # the image after scaling to the colormap, so it is left out
+    labels = []
+    for _ in range(rng.integers(*settings.BLOBS, endpoint=True)):
+        box = add_blob(data, rng.integers(*settings.BLOB_ROW, endpoint=True),
+                       rng.integers(*settings.BLOB_COLUMN, endpoint=True),
+                       rng.integers(*settings.BLOB_SIGMA_ROW, endpoint=True),
+                       rng.integers(*settings.BLOB_SIGMA_COLUMN, endpoint=True), settings.BLOB_AMPLITUDE, settings)
+        labels.append((CLASSES.index('blob'),) + box)
+
+    for _ in range(rng.integers(*settings.HYPERBOLAS, endpoint=True)):
+        box = add_hyperbola(data, rng.integers(*settings.HYPERBOLA_APEX_ROW, endpoint=True),
+                            rng.integers(0, columns), rng.uniform(*settings.HYPERBOLA_VELOCITY),
+                            rng.integers(*settings.HYPERBOLA_HALF_WIDTH, endpoint=True),
+                            rng.uniform(*settings.HYPERBOLA_AMPLITUDE), settings)
+        if box is not None:
+            labels.append((CLASSES.index('hyperbola'),) + box)
+
+    add_lines(data, rng, settings)
+    return data, labels
+
+
+# Converts (class id, x1, y1, x2, y2) boxes to YOLO label lines, clipped to the image
+def yolo_labels(labels, rows, columns):
+    lines = []
+    for class_id, x1, y1, x2, y2 in labels:
+        x1, x2 = np.clip([x1, x2], 0, columns)
+        y1, y2 = np.clip([y1, y2], 0, rows)
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            continue  # outside the image
+        lines.append(f"{class_id} {(x1 + x2) / 2 / columns:.6f} {(y1 + y2) / 2 / rows:.6f} "
+                     f"{(x2 - x1) / columns:.6f} {(y2 - y1) / rows:.6f}")
+    return lines
+
+
+# Worker state, set once per process
+lut = None
+job = None
+
+
+def init_worker(output, seed, settings):
+    global lut, job
+    lut = jet_lut()
+    job = (output, seed, settings)
+
+
+# Generates and writes radargram index, returns the number of labelled objects
+def write_one(index):
+    output, seed, settings = job
+    rng = np.random.default_rng([seed, index])  # every image is reproducible on its own
+    data, labels = generate(rng, settings)
+
+    image = apply_colormap(data, lut)
+    if settings.SIZE is not None:
+        image = cv2.resize(image, tuple(settings.SIZE), interpolation=cv2.INTER_AREA)
+    lines = yolo_labels(labels, *data.shape)  # normalized, independent of the image size
+
+    name = f"{index:06d}"
+    cv2.imwrite(os.path.join(output, 'images', name + '.png'), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+    with open(os.path.join(output, 'labels', name + '.txt'), 'w') as file:
+        file.write('\n'.join(lines) + ('\n' if lines else ''))
+    return len(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic GPR radargrams with YOLO labels')
+    parser.add_argument('--count', type=int, default=1000, help='number of radargrams')
+    parser.add_argument('--output', default='synthetic', help='output directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='generating processes')
+    parser.add_argument('--seed', type=int, default=0, help='seed, the same seed gives the same images')
+    parser.add_argument('--start', type=int, default=0, help='index of the first image, to extend a data set')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), help='resize images')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+    settings = Settings()
+    settings.SIZE = args.size
+    for directory in ('images', 'labels'):
+        os.makedirs(os.path.join(args.output, directory), exist_ok=True)
+    with open(os.path.join(args.output, 'data.yaml'), 'w') as file:
+        file.write(f"path: {os.path.abspath(args.output)}\ntrain: images\nval: images\n"
+                   f"names:\n" + ''.join(f"  {i}: {name}\n" for i, name in enumerate(CLASSES)))
+
+    start = time.perf_counter()
+    objects = 0
+    with Pool(args.workers, initializer=init_worker, initargs=(args.output, args.seed, settings)) as pool:
+        indices = range(args.start, args.start + args.count)
+        for done, count in enumerate(pool.imap_unordered(write_one, indices, chunksize=16), 1):
+            objects += count
+            if done % 1000 == 0 or done == args.count:
+                elapsed = time.perf_counter() - start
+                logging.info(f"{done}/{args.count} radargrams, {objects} objects, {done / elapsed:.1f} per second")
+
+
+if __name__ == '__main__':
+    main()
@@ -31,55 +31,47 @@ V_act_intr = np.linspace(0, 20 * amp_scale, N0 * interp_coeff, endpoint=True)
 f_act_intr = interp_func(V_act_intr)
 
 
+# Sample times of one period, the same values as i * dt in a loop over i
+def sample_times(T, N):
+    return np.arange(N) * (T / N)  # ms
+
+
 # Triangular wave:
 def W_form_triang(f_min_tr, f_max_tr, T, N=N0):
     f_triang = np.empty(N)
-    dt = T / N  # ms
+    t = sample_times(T, N)  # Time values
     coeff_tr = 2 * (f_max_tr - f_min_tr) / T  # Triangular wave tangent
 
     # Calculate VCO output frequency values [N] for a triangular wave:
-    for i in range(0, N):
-        t = i * dt  # Current time value
-        if 0 <= t < T / 2:
-            f_triang[i] = (coeff_tr * t + f_min_tr)  # The straight line equation
-        elif T / 2 <= t < T:
-            f_triang[i] = (-coeff_tr * t + 2 * f_max_tr - f_min_tr)  # The straight line equation
+    rising = (0 <= t) & (t < T / 2)
+    falling = (T / 2 <= t) & (t < T)
+    f_triang[rising] = coeff_tr * t[rising] + f_min_tr  # The straight line equation
+    f_triang[falling] = -coeff_tr * t[falling] + 2 * f_max_tr - f_min_tr  # The straight line equation
     return f_triang
 
 
 # Rectangular wave:
 def W_form_rectang(f_min_rec, f_max_rec, T, N=N0):
     f_rectang = np.empty(N)
-    dt = T / N  # ms
+    t = sample_times(T, N)  # Time values
     # Calculate VCO output frequency values [N] for a rectangular wave:
-    for i in range(0, N):
-        t = i * dt  # Current time value
-        if 0 <= t < T / 2:
-            f_rectang[i] = f_max_rec
-        elif T / 2 <= t < T:
-            f_rectang[i] = f_min_rec
+    f_rectang[(0 <= t) & (t < T / 2)] = f_max_rec
+    f_rectang[(T / 2 <= t) & (t < T)] = f_min_rec
     return f_rectang
 
 
 # Sawtooth wave:
 def W_form_sawtooth(f_min_s, f_max_s, T, N=N0):
-    f_sawtooth = np.empty(N)
     dt = T / N  # ms
     coeff_s = (f_max_s - f_min_s) / ((N - 1) * dt)  # Sawtooth wave tangent
     # Calculate VCO output frequency values [N] for a sawtooth wave:
-    for i in range(0, N):
-        t = i * dt  # Current time value
-        f_sawtooth[i] = (coeff_s * t + f_min_s)  # The straight line equation
-    return f_sawtooth
+    return coeff_s * sample_times(T, N) + f_min_s  # The straight line equation
 
 
 # No transmission:
 def W_form_no(f_min_n, N=N0):
-    f_no = np.empty(N)
-    # Calculate VCO output frequency values [N]:
-    for i in range(0, N):
-        f_no[i] = f_min_n
-    return f_no
+    # VCO output frequency values [N]:
+    return np.full(N, f_min_n, dtype=np.float64)
 
 
 # Function for calculation and predistortion of DAC voltages for the desired VCO output:
@@ -88,14 +80,26 @@ def find_nearest(array, value):  # Function for finding a value nearest to the g
     return array[idx], idx  # Returns the nearest value and its index
 
 
+# Indices of the values nearest to the given values in a sorted array, the same as find_nearest
+# for every value (on equal distance the first index wins) in O(log n) per value
+def find_nearest_sorted(array, values):
+    values = np.asarray(values, dtype=np.float64)
+    upper = np.clip(np.searchsorted(array, values), 0, len(array) - 1)  # first element >= value
+    lower = np.searchsorted(array, array[np.maximum(upper - 1, 0)])  # first of the elements below
+    idx = np.where(np.abs(array[lower] - values) <= np.abs(array[upper] - values), lower, upper)
+    return np.where(np.isfinite(values), idx, 0)  # all distances are inf or nan, argmin returns 0
+
+
+# The documented frequencies grow with the voltage, which allows the binary search
+f_act_sorted = bool(np.all(np.diff(f_act_intr) >= 0))
+
+
 # Calculates DAC voltages required for the VCO producing f_desired,
 # in accordance with the documented non-linear dependence f(V):
 def predistort(f_desired):
-    N = len(f_desired)
-    f_dac = np.empty(N)
-    DAC_values = np.empty(N)
     # Correlate desired freq values with the documented ("actual_interpolated") values:
-    for i in range(0, N):
-        f_dac[i], idx = find_nearest(f_act_intr, f_desired[i])  # find actual freq value nearest to the desired freq
-        DAC_values[i] = V_act_intr[idx]
-    return DAC_values
+    if f_act_sorted:
+        idx = find_nearest_sorted(f_act_intr, f_desired)  # actual freq values nearest to the desired freq
+    else:
+        idx = np.array([find_nearest(f_act_intr, f)[1] for f in f_desired], dtype=np.intp)
+    return V_act_intr[idx]
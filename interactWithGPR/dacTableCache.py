@@ -0,0 +1,159 @@
+"""
+Used to cache the packed DAC buffers sent to the microcontroller, keyed by the waveform parameters.
+Buffers come from an optional memory-mapped table of the whole slider grid, from a bounded LRU cache,
+or are calculated on first use.
+
+Precompute the table once (takes a few minutes for the full grid):
+python dacTableCache.py --output dac_table.bin
+"""
+
+from collections import OrderedDict
+import argparse
+import json
+import os
+import struct
+import time
+
+import numpy as np
+import calculateDACwithPredistortion as dac
+
+# Table file layout: magic, header length, JSON header, then float32 records of N DAC values + dt
+MAGIC = b'DACTBL01'
+HEADER_LENGTH = struct.Struct('<I')
+
+# Slider grid, same as the sliders in sliders.py
+F_MIN = 1400.0  # MHz
+F_MAX = 3323.1  # MHz
+F_STEP = 5  # MHz
+PERIODS = tuple(range(10, 101, 10))  # ms
+WAVEFORMS = (1, 2, 3)  # 1 - triangular, 2 - rectangular, 3 - sawtooth, (4 - no transmission)
+
+
+# Calculates the buffer for the microcontroller: N DAC values normalized to 0...1 and the time between
+# DAC updates in us, packed as native float32
+def packed_values(waveform, f_min, f_max, T, N=dac.N0):
+    # Calculate desired VCO frequencies:
+    if waveform == 1:
+        f_desired = dac.W_form_triang(f_min, f_max, T, N)
+    elif waveform == 2:
+        f_desired = dac.W_form_rectang(f_min, f_max, T, N)
+    elif waveform == 3:
+        f_desired = dac.W_form_sawtooth(f_min, f_max, T, N)
+    else:
+        f_desired = dac.W_form_no(f_min, N)
+
+    # Calculate DAC voltage for f_desired:
+    DAC_values = dac.predistort(f_desired)
+
+    dt = T * 1000 / N  # *1000 - ms-->us, dt is time between DAC's updates
+    DAC_values /= 5.5  # normalize by 5.5 V for microcontroller Analog Output ( - accepts 0...1)
+    return np.append(DAC_values, dt).astype(np.float32)  # same values as struct.pack('f') of each one
+
+
+# Frequencies of the slider grid
+def grid_frequencies(f_min=F_MIN, f_max=F_MAX, step=F_STEP):
+    return np.arange(f_min, f_max, step, dtype=np.float64)
+
+
+# Precomputed buffers of the slider grid in a memory-mapped file. Only pairs with F_min < F_max are stored
+class DacTable:
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a DAC table")
+            length, = HEADER_LENGTH.unpack(file.read(HEADER_LENGTH.size))
+            header = json.loads(file.read(length))
+
+        self.N = header['N']
+        self.frequencies = {f: i for i, f in enumerate(grid_frequencies(header['f_min'], header['f_max'],
+                                                                        header['f_step']))}
+        self.periods = {T: i for i, T in enumerate(header['periods'])}
+        self.waveforms = {waveform: i for i, waveform in enumerate(header['waveforms'])}
+        pairs = len(self.frequencies) * (len(self.frequencies) - 1) // 2
+        self.values = np.memmap(path, dtype=np.float32, mode='r', offset=len(MAGIC) + HEADER_LENGTH.size + length,
+                                shape=(len(self.waveforms), len(self.periods), pairs, self.N + 1))
+
+    # Index of the pair f_min < f_max
+    @staticmethod
+    def pair_index(i_min, i_max):
+        return i_max * (i_max - 1) // 2 + i_min
+
+    # Returns the buffer, None if the parameters are not on the grid
+    def get(self, waveform, f_min, f_max, T, N):
+        i_min, i_max = self.frequencies.get(f_min), self.frequencies.get(f_max)
+        if N != self.N or i_min is None or i_max is None or i_min >= i_max or \
+                waveform not in self.waveforms or T not in self.periods:
+            return None
+        return self.values[self.waveforms[waveform], self.periods[T], self.pair_index(i_min, i_max)].tobytes()
+
+    # Writes the table of the whole grid
+    @staticmethod
+    def create(path, waveforms=WAVEFORMS, periods=PERIODS, N=dac.N0, f_min=F_MIN, f_max=F_MAX, f_step=F_STEP):
+        frequencies = grid_frequencies(f_min, f_max, f_step)
+        header = json.dumps({'N': N, 'f_min': f_min, 'f_max': f_max, 'f_step': f_step,
+                             'periods': list(periods), 'waveforms': list(waveforms)}).encode()
+        pairs = len(frequencies) * (len(frequencies) - 1) // 2
+        offset = len(MAGIC) + HEADER_LENGTH.size + len(header)
+
+        with open(path, 'wb') as file:
+            file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        values = np.memmap(path, dtype=np.float32, mode='r+', offset=offset,
+                           shape=(len(waveforms), len(periods), pairs, N + 1))
+
+        for w, waveform in enumerate(waveforms):
+            for p, T in enumerate(periods):
+                for i_max in range(1, len(frequencies)):
+                    for i_min in range(i_max):
+                        values[w, p, DacTable.pair_index(i_min, i_max)] = packed_values(
+                            waveform, frequencies[i_min], frequencies[i_max], T, N)
+        values.flush()
+
+
+# LRU cache of packed buffers limited to max_bytes, in front of an optional precomputed table
+class DacTableCache:
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, table_path=None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.buffers = OrderedDict()
+        self.table = DacTable(table_path) if table_path is not None and os.path.exists(table_path) else None
+
+    # Returns the buffer for the microcontroller
+    def get(self, waveform, f_min, f_max, T, N=dac.N0):
+        key = (waveform, float(f_min), float(f_max), float(T), N)
+        buffer = self.buffers.get(key)
+        if buffer is not None:
+            self.buffers.move_to_end(key)
+            return buffer
+
+        if self.table is not None:
+            buffer = self.table.get(*key)
+        if buffer is None:
+            buffer = packed_values(*key).tobytes()
+
+        self.buffers[key] = buffer
+        self.size += len(buffer)
+        while self.size > self.max_bytes and len(self.buffers) > 1:
+            self.size -= len(self.buffers.popitem(last=False)[1])
+        return buffer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute DAC buffers of the whole slider grid')
+    parser.add_argument('--output', default='dac_table.bin', help='table file')
+    parser.add_argument('--waveforms', type=int, nargs='*', default=list(WAVEFORMS), help='waveforms to include')
+    parser.add_argument('--periods', type=int, nargs='*', default=list(PERIODS), help='periods in ms to include')
+    args = parser.parse_args()
+
+    pairs = len(grid_frequencies()) * (len(grid_frequencies()) - 1) // 2
+    size = len(args.waveforms) * len(args.periods) * pairs * (dac.N0 + 1) * 4
+    print(f"Writing {size / 2 ** 20:.0f} MB to {args.output}")
+
+    start = time.perf_counter()
+    DacTable.create(args.output, args.waveforms, args.periods)
+    print(f"Done in {time.perf_counter() - start:.0f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Used to send DAC buffers to the microcontroller without blocking the GUI. A writer thread sends the latest
+buffer only, older buffers that were not sent yet are replaced. The port is opened again with backoff when it
+fails. Optionally buffers are framed with length and checksum, and the device acknowledges every frame,
+which gives the round trip latency.
+
+Frame:       0xAA 0x55 | sequence (1 byte) | payload length (uint16 LE) | payload | CRC-32 (uint32 LE)
+Acknowledge: 0x06 | sequence (1 byte), 0x15 | sequence (1 byte) if the checksum did not match
+The CRC-32 covers sequence, length and payload.
+"""
+
+from threading import Condition, Thread
+import struct
+import time
+import zlib
+
+import serial
+
+SYNC = b'\xaa\x55'
+HEADER = struct.Struct('<BH')  # sequence, payload length
+CHECKSUM = struct.Struct('<I')
+ACK = 0x06
+NAK = 0x15
+
+
+# Opens a serial port by name or pyserial URL, for example "COM3", or "loop://" for a loopback
+# (the loopback echoes frames instead of acknowledging them, use it unframed)
+def open_port(url, **kwargs):
+    return serial.serial_for_url(url, **kwargs)
+
+
+# Wraps a payload into a frame
+def frame(sequence, payload):
+    header = HEADER.pack(sequence, len(payload))
+    return SYNC + header + payload + CHECKSUM.pack(zlib.crc32(payload, zlib.crc32(header)))
+
+
+# Parses frames from a byte stream. Returns (frames, rest), frames are (sequence, payload or None if the
+# checksum does not match), rest is the beginning of an incomplete frame
+def parse_frames(data):
+    frames = []
+    while True:
+        start = data.find(SYNC)
+        if start < 0:
+            return frames, data[-1:] if data[-1:] == SYNC[:1] else b''
+        data = data[start:]
+        if len(data) < len(SYNC) + HEADER.size:
+            return frames, data
+
+        sequence, length = HEADER.unpack_from(data, len(SYNC))
+        end = len(SYNC) + HEADER.size + length + CHECKSUM.size
+        if len(data) < end:
+            return frames, data
+
+        header = data[len(SYNC):len(SYNC) + HEADER.size]
+        payload = data[len(SYNC) + HEADER.size:end - CHECKSUM.size]
+        checksum, = CHECKSUM.unpack_from(data, end - CHECKSUM.size)
+        frames.append((sequence, payload if zlib.crc32(payload, zlib.crc32(header)) == checksum else None))
+        data = data[end:]
+
+
+# Stand-in for the microcontroller with the port interface used by SerialTransport. Acknowledges framed
+# buffers after delay seconds, keeps the received payloads in received
+class FakeDevice:
+    timeout = 1.0  # seconds read waits for a reply, like the pyserial read timeout
+
+    def __init__(self, delay=0.0, framed=True):
+        self.delay = delay
+        self.framed = framed
+        self.received = []
+        self.pending = b''
+        self.replies = b''
+        self.condition = Condition()
+        self.is_open = True
+
+    def write(self, data):
+        time.sleep(self.delay)
+        with self.condition:
+            if not self.framed:
+                self.received.append(bytes(data))
+                return len(data)
+
+            frames, self.pending = parse_frames(self.pending + bytes(data))
+            for sequence, payload in frames:
+                if payload is not None:
+                    self.received.append(payload)
+                self.replies += bytes([ACK if payload is not None else NAK, sequence])
+            self.condition.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.replies) > 0 or not self.is_open, self.timeout)
+            data, self.replies = self.replies[:size], self.replies[size:]
+            return data
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+
+# Sends buffers from a background thread. send() returns immediately, when the writer is busy
+# the pending buffer is replaced by the newer one (counted in coalesced).
+# port is an open port or a function returning one. A function is called in the writer thread, and again
+# after port errors, waiting retry_delay seconds, doubled after every failure up to max_retry_delay.
+# An open port is not reopened, its writes are retried with the same backoff.
+# framed - frame buffers and wait for acknowledges, the device firmware has to support it
+class SerialTransport:
+
+    def __init__(self, port, framed=False, ack_timeout=1.0, retries=2, retry_delay=0.5, max_retry_delay=5.0):
+        self.factory = port if callable(port) else None
+        self.port = None if callable(port) else port
+        self.framed = framed
+        self.ack_timeout = ack_timeout
+        self.retries = retries  # resends of an unacknowledged frame when no newer buffer is waiting
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self.condition = Condition()
+        self.pending = None  # latest buffer not sent yet
+        self.busy = False  # the writer is sending a buffer
+        self.connected = self.port is not None  # False while the port is not open or failed
+        self.running = True
+        self.sequence = 0
+
+        # Statistics
+        self.sent = 0
+        self.coalesced = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.latency = None  # seconds from write to acknowledge of the last frame
+        self.error = None  # last port error
+
+        self.thread = Thread(target=self.run, name='serial-writer', daemon=True)
+        self.thread.start()
+
+    # Queues a buffer, replacing the one waiting to be sent. Returns False while the port is down,
+    # the buffer is then sent once the port works again
+    def send(self, payload):
+        with self.condition:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = bytes(payload)
+            self.condition.notify_all()
+            return self.connected
+
+    # Waits until every queued buffer was written. Returns False on timeout, and at once while the port is down
+    def flush(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: (self.pending is None and not self.busy) or not self.connected, timeout)
+            return self.pending is None and not self.busy
+
+    # Writer thread
+    def run(self):
+        delay = self.retry_delay
+        while True:
+            if self.port is None and not self.connect():
+                if not self.backoff(delay):
+                    return
+                delay = min(2 * delay, self.max_retry_delay)
+                continue
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or not self.running)
+                if not self.running:
+                    return
+                payload, self.pending = self.pending, None
+                self.busy = True
+
+            try:
+                self.write(payload)
+                self.error = None
+                delay = self.retry_delay
+                failed = False
+            except (serial.SerialException, OSError) as e:
+                self.error = e
+                failed = True
+
+            with self.condition:
+                self.busy = False
+                self.connected = not failed
+                if failed and self.pending is None:
+                    self.pending = payload  # send it again once the port works
+                self.condition.notify_all()
+
+            if failed:
+                self.disconnect()
+                if not self.backoff(delay):
+                    return
+                delay = min(2 * delay, self.max_retry_delay)
+
+    # Opens the port, returns False on failure
+    def connect(self):
+        try:
+            port = self.factory()
+        except (serial.SerialException, OSError) as e:
+            self.error = e
+            return False
+
+        with self.condition:
+            if not self.running:
+                port.close()  # closed while opening
+                return False
+            self.port = port
+            self.error = None
+            self.connected = True
+            self.condition.notify_all()
+        return True
+
+    # Closes a failed port so it is opened again, a port that cannot be reopened is kept
+    def disconnect(self):
+        if self.factory is None:
+            return
+
+        try:
+            self.port.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.port = None
+
+    # Waits delay seconds before the next attempt, returns False when the transport was closed meanwhile
+    def backoff(self, delay):
+        with self.condition:
+            return not self.condition.wait_for(lambda: not self.running, delay)
+
+    # Writes one buffer, framed buffers are resent until acknowledged
+    def write(self, payload):
+        if not self.framed:
+            self.port.write(payload)
+            self.sent += 1
+            return
+
+        self.sequence = (self.sequence + 1) % 256
+        data = frame(self.sequence, payload)
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            self.port.write(data)
+            self.sent += 1
+            if self.wait_ack(self.sequence):
+                self.latency = time.perf_counter() - start
+                self.acknowledged += 1
+                return
+            if self.pending is not None:
+                break  # a newer buffer replaces this one anyway
+        self.failed += 1
+
+    # Reads replies until the acknowledge of sequence arrives, returns False on NAK or timeout.
+    # Needs a port with a read timeout
+    def wait_ack(self, sequence):
+        deadline = time.monotonic() + self.ack_timeout
+        while time.monotonic() < deadline:
+            reply = self.port.read(1)
+            if len(reply) == 0 or reply[0] not in (ACK, NAK):
+                continue  # timeout or noise, resynchronize on the next reply byte
+            if self.port.read(1) == bytes([sequence]):
+                return reply[0] == ACK
+        return False
+
+    # Stops the writer thread and closes the port
+    def close(self, timeout=1.0):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        if self.port is not None:
+            self.port.close()
+
+    # Short status for the GUI
+    def status(self):
+        if self.error is not None:
+            return f"Port error: {self.error}, retrying"
+        status = f"Sent {self.sent}, replaced {self.coalesced}"
+        if self.framed:
+            status += f", acknowledged {self.acknowledged}, failed {self.failed}"
+            if self.latency is not None:
+                status += f", latency {1000 * self.latency:.1f} ms"
+        return status
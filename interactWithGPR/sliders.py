@@ -3,17 +3,19 @@ Used to show GUI for GPR interaction
 """
 
 from tkinter import Scale, Button, VERTICAL, Tk, Menu, messagebox, Label, TclError
-from struct import pack
 
-import serial
-from numpy import append
-import calculateDACwithPredistortion as dac  # Functions available: W_form_triang, W_form_rectang(),
-#                                                                 W_form_sawtooth(), predistort()
+from dacTableCache import DacTableCache  # packed DAC buffers calculated with calculateDACwithPredistortion
+from serialTransport import SerialTransport, open_port
 
 # Configure the Serial port:
-# Change COM number according to your PC connection
-ser = serial.Serial("COM3", baudrate=9600, bytesize=8, parity='N',
-                    stopbits=1, timeout=None, rtscts=1)
+# Change COM number according to your PC connection, "loop://" runs without the microcontroller
+PORT = "COM3"
+FRAMED = False  # length + checksum framing with acknowledges, needs firmware support
+
+# The port is opened and written in a background thread, so a stalled microcontroller does not freeze the GUI.
+# Only the latest buffer is sent when the sliders change faster than the port can follow
+ser = SerialTransport(lambda: open_port(PORT, baudrate=9600, bytesize=8, parity='N', stopbits=1,
+                                        timeout=0.1, write_timeout=1, rtscts=1), framed=FRAMED)
 
 # Default Signal Parameters:
 # (F_max should be changed for the new RF-chain with the voltage amplifier)
@@ -23,6 +25,10 @@ F_max_df = 3323.1  # Maximum frequency of the radar signal [MHz]  # 5.5 V <-> 21
 T_df = 20  # Period of the signal in [ms]
 W_form_df = 1  # 1 - triangular, 2 - rectangular, 3 - sawtooth waveforms, (4 - no transmission)
 
+# Buffers of recently used settings are kept, buffers of the whole slider grid are read from the table
+# if it was precomputed with dacTableCache.py
+dac_cache = DacTableCache(table_path='dac_table.bin')
+
 # Create a main window:
 window = Tk()
 
@@ -51,6 +57,7 @@ def helpBox():
 def closeWindow():
     confirmation = messagebox.askokcancel(title="Exit", message="Do you want to exit?")
     if confirmation:
+        ser.close()  # Stop the writer thread and close the port
         window.destroy()  # Destroy the main window
 
 
@@ -73,24 +80,12 @@ def getSlider():
         T = sldT.get()
         W_form = sldW.get()
 
-        # Calculate desired VCO frequencies:
-        if W_form == 1:
-            f_desired = dac.W_form_triang(F_min, F_max, T)
-        elif W_form == 2:
-            f_desired = dac.W_form_rectang(F_min, F_max, T)
-        elif W_form == 3:
-            f_desired = dac.W_form_sawtooth(F_min, F_max, T)
-
-        # Calculate DAC voltage for f_desired:
-        DAC_values = dac.predistort(f_desired)
+        # DAC voltages for the desired VCO frequencies, normalized to 0...1, and the time between DAC updates,
+        # each packed into a float - 4 bytes
+        str_packed = dac_cache.get(W_form, F_min, F_max, T, num_values)
 
         # Transmit data to microcontroller:
-        dt = T * 1000 / num_values  # *1000 - ms-->us, dt is time between DAC's updates
-        DAC_values /= 5.5  # normalize by 5.5 V for microcontroller Analog Output ( - accepts 0...1)
-
-        values_to_pack = append(DAC_values, dt)  # uniting two arrays
-        str_packed = pack('%sf' % len(values_to_pack), *values_to_pack)  # pack each value into a float - 4 bytes
-        num_bytes = ser.write(str_packed)  # Sending data to microcontroller through Serial
+        ser.send(str_packed)  # Sending data to microcontroller through Serial, returns at once
 
         # Warning if F_min < F_max:
     else:
@@ -104,17 +99,11 @@ def stopGPR():
     F_min = F_min_df  # Using default values
     T = T_df
 
-    # Calculate desired VCO frequencies:
-    f_desired = dac.W_form_no(F_min)
-    # Calculate DAC voltage for f_desired:
-    DAC_values = dac.predistort(f_desired)
+    # Constant minimum frequency (waveform 4), packed like the other waveforms
+    str_packed = dac_cache.get(4, F_min, F_min, T, num_values)
 
     # Transmit data to microcontroller:
-    dt = T * 1000 / num_values  # *1000 - ms-->us, dt is time between DAC's updates
-    DAC_values /= 5.5  # normalize by 5.5 V for microcontroller Analog Output ( - accepts 0...1)
-    values_to_pack = append(DAC_values, dt)
-    str_packed = pack('%sf' % len(values_to_pack), *values_to_pack)  # pack each value into a float - 4 bytes
-    num_bytes = ser.write(str_packed)  # Sending data to microcontroller through Serial
+    ser.send(str_packed)  # Sending data to microcontroller through Serial, returns at once
 
 
 # Confirmation buttons to get the Sliders values and send them to microcontroller:
@@ -127,6 +116,10 @@ stopB = Button(window, text="Stop", command=stopGPR)
 stopB.pack(side="bottom", expand=1, fill="none")
 stopB.configure(font=("Adobe Hebrew", "9", "bold"))
 
+# Serial status line:
+statusLabel = Label(window, font=("Adobe Hebrew", "9"))
+statusLabel.pack(side="bottom")
+
 # Create four SLIDERS to set Fmin, Fmax, T  and Waveform:
 # 'tickinterval' - desplayed slider steps, 'resolution' - actual slider steps
 
@@ -170,5 +163,14 @@ wave = "Waveform:\n\n1=triangular,\n\n2=rectangular,\n\n3=sawtooth"
 label4 = Label(text=wave, font=("Adobe Hebrew", "10", "bold"))
 label4.pack(side="left", expand=1)
 
+
+# Refreshes the serial status line twice a second:
+def updateStatus():
+    statusLabel.configure(text=ser.status())
+    window.after(500, updateStatus)
+
+
+updateStatus()
+
 # Start the Main loop:
 window.mainloop()
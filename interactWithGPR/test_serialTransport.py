@@ -0,0 +1,193 @@
+"""
+Tests of the serial transport against the fake device and the pyserial loopback, run with: python -m pytest
+"""
+
+import time
+
+import serial
+
+from serialTransport import FakeDevice, SerialTransport, frame, open_port, parse_frames
+
+
+# Fake device that corrupts the first frame it receives, so it answers with NAK once
+class CorruptingDevice(FakeDevice):
+
+    def __init__(self):
+        super().__init__()
+        self.corrupted = False
+
+    def write(self, data):
+        if not self.corrupted:
+            self.corrupted = True
+            data = bytearray(data)
+            data[-1] ^= 0xFF
+        return super().write(data)
+
+
+# Port function that fails failures times before it returns device
+class FlakyPort:
+
+    def __init__(self, device, failures):
+        self.device = device
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise serial.SerialException("port busy")
+        return self.device
+
+
+# Waits until condition() is true, fails the test after timeout seconds
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_frame_round_trip():
+    data = frame(7, b'abc') + frame(8, b'')
+    frames, rest = parse_frames(b'noise' + data)
+    assert frames == [(7, b'abc'), (8, b'')]
+    assert rest == b''
+
+
+def test_frame_split_and_corrupted():
+    data = frame(1, b'payload')
+    frames, rest = parse_frames(data[:5])
+    assert frames == [] and rest == data[:5]
+    frames, rest = parse_frames(rest + data[5:])
+    assert frames == [(1, b'payload')]
+
+    corrupted = bytearray(data)
+    corrupted[6] ^= 0x01  # inside the payload
+    assert parse_frames(bytes(corrupted))[0] == [(1, None)]
+
+
+def test_coalesces_buffers_while_busy():
+    device = FakeDevice(delay=0.2, framed=False)
+    transport = SerialTransport(device)
+    try:
+        assert transport.send(b'first')
+        wait_until(lambda: transport.busy)
+        for payload in (b'second', b'third', b'latest'):
+            transport.send(payload)
+        assert transport.flush(timeout=2)
+        assert device.received == [b'first', b'latest']
+        assert transport.coalesced == 2
+        assert transport.sent == 2
+    finally:
+        transport.close()
+
+
+def test_framed_buffers_are_acknowledged():
+    device = FakeDevice()
+    transport = SerialTransport(device, framed=True)
+    try:
+        transport.send(b'\x01\x02\x03')
+        assert transport.flush(timeout=2)
+        assert device.received == [b'\x01\x02\x03']
+        assert transport.acknowledged == 1 and transport.failed == 0
+        assert transport.latency is not None
+    finally:
+        transport.close()
+
+
+def test_nak_resends_frame():
+    device = CorruptingDevice()
+    transport = SerialTransport(device, framed=True)
+    try:
+        transport.send(b'data')
+        assert transport.flush(timeout=2)
+        assert device.received == [b'data']
+        assert transport.sent == 2  # NAK, then the resend is acknowledged
+        assert transport.acknowledged == 1 and transport.failed == 0
+    finally:
+        transport.close()
+
+
+def test_missing_acknowledge_fails_after_retries():
+    device = FakeDevice(framed=False)  # never answers
+    device.timeout = 0.01
+    transport = SerialTransport(device, framed=True, ack_timeout=0.05, retries=1)
+    try:
+        transport.send(b'data')
+        assert transport.flush(timeout=2)
+        assert transport.sent == 2 and transport.failed == 1 and transport.acknowledged == 0
+    finally:
+        transport.close()
+
+
+def test_loopback_port():
+    transport = SerialTransport(lambda: open_port('loop://', timeout=0.1))
+    try:
+        wait_until(lambda: transport.connected)
+        transport.send(b'\x00\x01\x02')
+        assert transport.flush(timeout=2)
+        assert transport.port.read(3) == b'\x00\x01\x02'
+    finally:
+        transport.close()
+
+
+def test_port_is_opened_again_with_backoff():
+    device = FakeDevice(framed=False)
+    port = FlakyPort(device, failures=2)
+    transport = SerialTransport(port, retry_delay=0.01)
+    try:
+        assert not transport.send(b'waiting')  # port not open yet
+        wait_until(lambda: transport.connected)
+        assert transport.flush(timeout=2)
+        assert device.received == [b'waiting']
+        assert port.calls == 3
+        assert transport.error is None and not transport.status().startswith("Port error")
+    finally:
+        transport.close()
+
+
+def test_send_and_flush_fail_fast_while_port_is_down():
+    def unavailable():
+        raise serial.SerialException("no such port")
+
+    transport = SerialTransport(unavailable, retry_delay=0.01)
+    try:
+        wait_until(lambda: transport.error is not None)
+        assert not transport.send(b'data')
+        start = time.monotonic()
+        assert not transport.flush()  # no timeout, must not wait for the port
+        assert time.monotonic() - start < 0.5
+        assert transport.status().startswith("Port error")
+    finally:
+        transport.close()
+
+
+# Port whose writes fail until it is repaired
+class BrokenPort(FakeDevice):
+
+    def __init__(self):
+        super().__init__(framed=False)
+        self.broken = True
+
+    def write(self, data):
+        if self.broken:
+            raise serial.SerialException("write failed")
+        return super().write(data)
+
+
+def test_error_is_cleared_after_a_successful_write():
+    device = BrokenPort()
+    transport = SerialTransport(device, retry_delay=0.01)
+    try:
+        transport.send(b'data')
+        wait_until(lambda: transport.error is not None)
+        assert not transport.flush(timeout=1)
+
+        device.broken = False
+        wait_until(lambda: device.received == [b'data'])
+        wait_until(lambda: transport.connected)
+        assert transport.error is None
+        assert transport.flush(timeout=1)
+    finally:
+        transport.close()
+
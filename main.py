@@ -2,52 +2,113 @@
 This file starts the program
 """
 
+import time
+
+start_time = time.perf_counter()  # taken before the imports to include them in the startup timing
+
 from utils.shared_variables import SharedVariables
+from ml.onnx import yolo as onnx_yolo
 from utils import screen_overlay_handler
+from utils.detection_scheduler import DetectionScheduler
+from utils.tracking import MultiTracking
+from utils.association import Associator, iou
+from utils.startup_timer import StartupTimer
+from utils.metrics import FileSink
+from utils import queued_logging
+from utils.process_pipeline import ProcessPipeline
 from utils.ThreadPool import *
-from pyfiglet import Figlet
 
-import time
 import logging
 
-logging.basicConfig(
-    level=logging.DEBUG,  # Set the logging threshold to DEBUG (or another level)
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='last-run.log',  # Log messages to a file (optional)
-    filemode='w'  # Append mode for the log file (optional)
-)
-console_handler = logging.StreamHandler()  # Use the default stream (sys.stdout)
 
-# Create a formatter for the console handler (optional)
-console_formatter = logging.Formatter('%(levelname)s - %(message)s')
-console_handler.setFormatter(console_formatter)
+# Logging is set up only in the main process, the pipeline processes re-import this file
+def configure_logging():
+    file_handler = logging.FileHandler('last-run.log', mode='w')  # Log messages to a file, overwritten every run
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    console_handler = logging.StreamHandler()  # Use the default stream (sys.stdout)
+
+    # Create a formatter for the console handler (optional)
+    console_formatter = logging.Formatter('%(levelname)s - %(message)s')
+    console_handler.setFormatter(console_formatter)
+
+    if QUEUED_LOGGING:
+        # Detection and tracking threads only put records on a queue, a listener thread writes them
+        queued_logging.start([file_handler, console_handler], LOG_LEVEL, LOG_QUEUE_SIZE, LOG_BURST)
+        return
+
+    # Add the handlers to the root logger
+    root_logger = logging.getLogger()
+    root_logger.setLevel(LOG_LEVEL)
+    root_logger.addHandler(file_handler)
+    root_logger.addHandler(console_handler)
 
-# Add the console handler to the root logger
-root_logger = logging.getLogger()
-root_logger.addHandler(console_handler)
 
 # Create a logger for your module
 logger = logging.getLogger('realtime-screen-object-detection.rsod')
 
+# Startup phases are reported once the first detection is done
+startup_timer = StartupTimer(start_time)
+startup_timer.mark("imports done")
+
 # Variables that can be changed
+MODEL_BACKEND = "torch"  # "torch" - PyTorch, "onnx" - ONNX Runtime, "onnx-int8" - quantized, "openvino" - OpenVINO
+INFERENCE_THREADS = 0  # CPU threads for onnx/openvino inference, 0 - runtime default
 MAX_BOX_AREA = 100000000  # pixels^2
 PRECISION = 0.3  # 30 % detection threshold
 MAX_DETECTION = 100
 MAX_TRACKING_MISSES = 5
+MAX_DETECTION_MISSES = 5  # detections in a row that do not confirm a box before it is removed
+MATCH_IOU = 0.3  # minimum overlap for a detection to confirm an existing box
+DRIFT_IOU = 0.7  # a confirming detection overlapping its box less than this restarts the tracker on it
+TRACKING_WORKERS = 2  # threads updating trackers, 0 - update all trackers in the tracking thread
 WIDTH = 1920  # 2560  # pixels
 HEIGHT = 1080  # 1440  # pixels
 SHOW_ONLY = ["FMCW-Radar-Output"]  # Start Empty, receive items to show
 OFFSET = (0, 0)
 DETECTION_SIZE = 640  # was 480
-DETECTION_DURATION = 1
+TILED_DETECTION = False  # detect on overlapping full resolution tiles, better recall for small objects, slower
+TILE_SIZE = 640  # pixels
+TILE_OVERLAP = 0.2  # fraction of TILE_SIZE
+TILE_NMS_IOU = 0.5  # merge boxes from neighbouring tiles overlapping more than this (of the smaller box)
+DETECTION_DURATION = 1  # max seconds to wait for a new frame
+DETECTION_RATE = 5  # target detections per second, 0 - as fast as inference allows
+DETECTION_BACKOFF = 1.5  # min time between detections as a multiple of inference time
+DETECT_ON_TRACKING_LOSS = True  # run detection right away when a tracker misses its object
 RESET_SHOW_ONLY_ON_START = False
+SHOW_BANNER = True  # render the Figlet banner on start
 RED_NUMBER = 240
+ZERO_COPY_CAPTURE = True
+CAPTURE_FPS = 30
+CHANGE_THRESHOLD = 4  # screen change sensitivity, lower - more sensitive, 0 - always run inference
+PROCESS_PIPELINE = False  # capture, inference and tracking in separate processes with shared memory frames
+PIPELINE_POLL_INTERVAL = 10  # milliseconds between checks for results of the pipeline processes
+METRICS_FILE = None  # e.g. "metrics.jsonl" - append pipeline metrics as JSON lines, None - no file
+METRICS_INTERVAL = 5  # seconds between metrics reports
+SHOW_METRICS = False  # paint capture fps, latencies, box and track counts in the overlay
+RECORD_FILE = None  # e.g. "session.frames" - record captured frames for replay, None - no recording
+REPLAY_FILE = None  # replay a recording instead of the screen, same WIDTH, HEIGHT and DETECTION_SIZE as recorded
+REPLAY_SPEED = 1.0  # 1 - recorded pace, 2 - twice as fast, 0 - as fast as possible
+REPLAY_LOOP = False  # start the recording over when it ends, also for sequences of B-scans
+BSCAN_SOURCE = None  # e.g. "bscans.npy" or "tcp://127.0.0.1:5005" - render raw B-scans instead of capturing the screen
+BSCAN_RANGE = None  # (min, max) of the colour scale, None - scaled to every B-scan like imagesc
+LOG_LEVEL = logging.DEBUG  # Set the logging threshold to DEBUG (or another level)
+QUEUED_LOGGING = True  # write log records in a background thread, logging never waits for the disk
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer, newer records are dropped when it is full
+LOG_BURST = 5  # debug records per second and call site, more are counted and dropped, 0 - no limit
 
 
 class MainGUI(QMainWindow):
 
     def initiate_shared_variables(self):
-        self.shared_variables = SharedVariables()
+        self.shared_variables = SharedVariables(start_capture=False)  # started once the model is loaded
+        if MODEL_BACKEND not in onnx_yolo.BACKENDS:
+            raise ValueError(f"Unknown MODEL_BACKEND {MODEL_BACKEND!r}, "
+                             f"expected one of {', '.join(onnx_yolo.BACKENDS)}")
+        self.shared_variables.MODEL_BACKEND = MODEL_BACKEND
+        self.shared_variables.INFERENCE_THREADS = INFERENCE_THREADS
+        if MODEL_BACKEND != "torch":
+            self.shared_variables.model = onnx_yolo.YOLO  # exported from best.pt on first start
         self.shared_variables.MAX_BOX_AREA = MAX_BOX_AREA
         self.shared_variables.PRECISION = PRECISION
         self.shared_variables.MAX_DETECTION = MAX_DETECTION
@@ -57,9 +118,30 @@ class MainGUI(QMainWindow):
         self.shared_variables.list = []
         self.shared_variables.OFFSET = OFFSET
         self.shared_variables.DETECTION_SIZE = DETECTION_SIZE
+        self.shared_variables.TILED_DETECTION = TILED_DETECTION
+        self.shared_variables.TILE_SIZE = TILE_SIZE
+        self.shared_variables.TILE_OVERLAP = TILE_OVERLAP
+        self.shared_variables.TILE_NMS_IOU = TILE_NMS_IOU
         self.shared_variables.DETECTION_DURATION = DETECTION_DURATION
+        self.shared_variables.DETECT_ON_TRACKING_LOSS = DETECT_ON_TRACKING_LOSS
         self.shared_variables.MAX_TRACKING_MISSES = MAX_TRACKING_MISSES
         self.shared_variables.RED_NUMBER = RED_NUMBER
+        self.shared_variables.ZERO_COPY_CAPTURE = ZERO_COPY_CAPTURE
+        self.shared_variables.CAPTURE_FPS = CAPTURE_FPS
+        self.shared_variables.CHANGE_THRESHOLD = CHANGE_THRESHOLD
+        self.shared_variables.METRICS_FILE = METRICS_FILE
+        self.shared_variables.METRICS_INTERVAL = METRICS_INTERVAL
+        self.shared_variables.SHOW_METRICS = SHOW_METRICS
+        self.shared_variables.RECORD_FILE = RECORD_FILE
+        self.shared_variables.REPLAY_FILE = REPLAY_FILE
+        self.shared_variables.REPLAY_SPEED = REPLAY_SPEED
+        self.shared_variables.REPLAY_LOOP = REPLAY_LOOP
+        self.shared_variables.BSCAN_SOURCE = BSCAN_SOURCE
+        self.shared_variables.BSCAN_RANGE = BSCAN_RANGE
+
+        if METRICS_FILE is not None:
+            self.shared_variables.metrics.add_sink(FileSink(METRICS_FILE))
+            self.shared_variables.metrics.start_reporting(METRICS_INTERVAL)
 
         if RESET_SHOW_ONLY_ON_START:
             self.shared_variables.SHOW_ONLY = []
@@ -67,61 +149,144 @@ class MainGUI(QMainWindow):
     def __init__(self):
         super(MainGUI, self).__init__()
 
-        self.initiate_shared_variables()
+        with startup_timer.phase("shared variables"):
+            self.initiate_shared_variables()
 
-        # Create detection and load model
-        self.detection_model = self.shared_variables.model(shared_variables=self.shared_variables)
-        self.detection_model.download_model()
-        self.detection_model.load_model()
+        self.first_detection = True
 
         self.threadpool = QThreadPool()
 
         logging.info("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
-        self.timer = QTimer()
-        self.timer.setInterval(10)
-        self.timer.timeout.connect(self.print_output)
-        self.timer.start()
-
-        # Start Detection thread
+        if PROCESS_PIPELINE:
+            # Capture, inference and tracking processes, the GUI thread only associates and paints
+            self.start_pipeline()
+        else:
+            # Create detection, the model is loaded in the background while the overlay comes up
+            self.detection_model = self.shared_variables.model(shared_variables=self.shared_variables)
+
+            # Decides when detection runs, trackers can trigger it through shared variables
+            self.scheduler = DetectionScheduler(self.shared_variables.frame_ring, DETECTION_RATE, DETECTION_BACKOFF,
+                                                metrics=self.shared_variables.metrics)
+            self.shared_variables.detection_scheduler = self.scheduler
+
+            # Load model and warm it up, detection starts when this is finished
+            self.start_model_worker()
+
+        # Single window that paints all tracking boxes
+        with startup_timer.phase("overlay"):
+            self.shared_variables.overlay = screen_overlay_handler.Overlay(self.shared_variables)
+
+        # Matches new detections to tracked boxes
+        self.associator = Associator(MATCH_IOU)
+
+        if not PROCESS_PIPELINE:
+            # Single tracking engine that updates all trackers once per new frame
+            self.tracking = MultiTracking(self.shared_variables, TRACKING_WORKERS)
+            QApplication.instance().aboutToQuit.connect(self.tracking.stop)  # ends the loop and its worker pool
+
+            # Start Tracking thread
+            self.start_tracking_worker()
+
+    # Loads the model and runs one inference on a dummy frame so the first real frame
+    # does not pay for lazy initialization
+    def load_model(self, progress_callback):
+        with startup_timer.phase("model load"):
+            self.detection_model.download_model()
+            self.detection_model.load_model()
+
+        if TILED_DETECTION:
+            shape = (TILE_SIZE, TILE_SIZE, 3)
+        else:
+            shape = (DETECTION_SIZE, int(WIDTH * DETECTION_SIZE / HEIGHT), 3)
+
+        with startup_timer.phase("model warm-up"):
+            self.detection_model.warm_up(shape)
+
+    # Starts capture and detection once the model is ready
+    def model_loaded(self, result):
+        logging.info("Model loaded")
+        with startup_timer.phase("capture start"):
+            self.shared_variables.start_streamer()
         self.start_worker()
 
+    # Model could not be loaded or warmed up, detection cannot start
+    def model_failed(self, error):
+        exctype, value, trace = error
+        logging.error("Model could not be loaded, detection is not started:\n" + trace)
+        QMessageBox.critical(None, "Detection not started", "Model could not be loaded: " + str(value))
+        QApplication.instance().quit()
+
     # detects object in background mode
     def background_detection(self, progress_callback):
         while True:
 
             if len(self.shared_variables.SHOW_ONLY) == 0:
                 # how often detections are made
-                pass
-            else:
+                time.sleep(self.shared_variables.DETECTION_DURATION)
+            elif self.scheduler.wait(self.shared_variables.DETECTION_DURATION):  # wait for a new frame
                 logging.debug("Trigger Detection...")
-                if self.shared_variables.OutputFrame is not None:  # wait for the first frame
-                    progress_callback.emit(self.detection_model.predict())  # detect and emit boxes
+                start_time = self.scheduler.start()
+                boxes = self.detection_model.predict()
+                self.scheduler.finish(start_time, self.detection_model.unchanged, self.detection_model.last_sequence)
+                if boxes is not None:  # None - no new frame or unchanged screen, nothing to associate
+                    progress_callback.emit(boxes)  # emit boxes
 
-            time.sleep(self.shared_variables.DETECTION_DURATION)
+                    self.mark_first_detection()
+
+    # Reports startup timing once the first detection is done
+    def mark_first_detection(self):
+        if self.first_detection:
+            self.first_detection = False
+            startup_timer.mark("first detection")
+            startup_timer.report()
 
     def create_tracking_boxes(self, boxes):
-        if len(boxes) > 0:
+        if len(boxes) > 0 and logging.root.isEnabledFor(logging.DEBUG):  # skip formatting the box list
             logging.debug(f"got detection now create trackerbox: {boxes}")
 
-        for box in boxes:
+        # Match detections to tracked boxes in one step
+        tracking_boxes = [tracking_box for tracking_box in self.shared_variables.list if not tracking_box.done]
+        detections = [screen_overlay_handler.frame_box(box[2], self.shared_variables) for box in boxes]
+        tracked = [tracking_box.get_box() for tracking_box in tracking_boxes]
+        matches, new_detections, unmatched = self.associator.match(detections, tracked)
+
+        # Matched detections confirm their box, the tracker only restarts when it drifted off the detection
+        overlaps = iou([detections[detection] for detection, _ in matches], [tracked[track] for _, track in matches])
+        for (detection, track), overlap in zip(matches, overlaps):
+            tracking_boxes[track].refresh(boxes[detection][0])
+            if overlap < DRIFT_IOU:
+                self.tracking.refresh_tracker(tracking_boxes[track].tracking, detections[detection])
+
+        # Boxes that detection keeps missing are removed
+        for track in unmatched:
+            tracking_boxes[track].misses += 1
+            if tracking_boxes[track].misses > MAX_DETECTION_MISSES:
+                self.tracking.remove_tracker(tracking_boxes[track].tracking)
+
+        # Unmatched detections start new boxes
+        for detection in new_detections:
+            box = boxes[detection]
             if len(self.shared_variables.list) < MAX_DETECTION:
-                self.shared_variables.list.append(
-                    screen_overlay_handler.TrackingBox(len(self.shared_variables.list), self.shared_variables, box[0],
-                                                       box[1], box[2]))
-
-    # Print output
-    def print_output(self):
-        remove = []
-        index = 0
-        for box in self.shared_variables.list:
-            if box.done:
-                box.finish(self)
-                remove.insert(0, index)
-            index += 1
-
-        for i in remove:
-            del self.shared_variables.list[i]
+                tracking_box = screen_overlay_handler.TrackingBox(len(self.shared_variables.list),
+                                                                  self.shared_variables, box[0], box[1], box[2])
+                self.shared_variables.list.append(tracking_box)
+                self.tracking.add_tracker(tracking_box.tracking)
+
+    # Print output, removes boxes whose tracking is lost and repaints the overlay
+    def print_output(self, trackings=None):
+        self.shared_variables.list[:] = [box for box in self.shared_variables.list if not box.done]
+        self.shared_variables.overlay.update()
+
+    # Associates detections of the inference process and repaints when the tracking process moved a box
+    def poll_pipeline(self):
+        detections, tracked = self.pipeline.poll()
+        for boxes in detections:
+            self.create_tracking_boxes(boxes)
+            self.mark_first_detection()
+
+        if tracked or len(detections) > 0:
+            self.print_output()
 
     def thread_complete(self):
         logging.debug("Thread closed")
@@ -136,11 +301,41 @@ class MainGUI(QMainWindow):
         # Execute
         self.threadpool.start(worker)
 
+    def start_model_worker(self):
+        worker = Worker(self.load_model)
+        worker.signals.result.connect(self.model_loaded)
+        worker.signals.error.connect(self.model_failed)
+        self.threadpool.start(worker)
+
+    def start_pipeline(self):
+        # Same add/refresh/remove interface as MultiTracking
+        self.pipeline = ProcessPipeline(self.shared_variables, DETECTION_RATE, DETECTION_BACKOFF, TRACKING_WORKERS)
+        self.tracking = self.pipeline
+
+        with startup_timer.phase("pipeline processes"):
+            self.pipeline.start()
+        QApplication.instance().aboutToQuit.connect(self.pipeline.stop)
+
+        self.pipeline_timer = QTimer(self)
+        self.pipeline_timer.timeout.connect(self.poll_pipeline)
+        self.pipeline_timer.start(PIPELINE_POLL_INTERVAL)
+
+    def start_tracking_worker(self):
+        worker = Worker(self.tracking.run)
+        worker.signals.progress.connect(self.print_output)  # all boxes of a frame at once
+        worker.signals.finished.connect(self.thread_complete)
+        self.threadpool.start(worker)
+
 
 # Main start here
 if __name__ == "__main__":
-    f = Figlet(font='slant')
-    logging.info(f.renderText('Realtime Screen stream with Ai detection Overlay'))
+    configure_logging()
+
+    if SHOW_BANNER:
+        from pyfiglet import Figlet
+
+        f = Figlet(font='slant')
+        logging.info(f.renderText('Realtime Screen stream with Ai detection Overlay'))
     logging.info("This program starts several threads that stream pc screen and" +
                  "run object detection on it and show detections with PyQt5 overlay.")
 
@@ -149,16 +344,29 @@ if __name__ == "__main__":
 
     logging.info("")
     logging.info("----- Settings -----")
+    logging.info("Model backend : " + MODEL_BACKEND)
     logging.info("Max box size : " + str(MAX_BOX_AREA))
     logging.info("Detection precision treshhold : " + str(100 * PRECISION) + "%")
     logging.info("Max amount of detection : " + str(MAX_DETECTION))
     logging.info("Max amount of tracking misses : " + str(MAX_TRACKING_MISSES))
-    logging.info("Do detections every : " + str(DETECTION_DURATION) + " second")
+    logging.info("Max amount of detection misses : " + str(MAX_DETECTION_MISSES))
+    logging.info("Detection match IoU : " + str(MATCH_IOU) + ", tracker drift IoU : " + str(DRIFT_IOU))
+    logging.info("Tracking worker threads : " + str(TRACKING_WORKERS))
+    logging.info("Process pipeline : " + str(PROCESS_PIPELINE))
+    logging.info("Target detection rate : " + str(DETECTION_RATE) + " per second")
+    logging.info("Detect on tracking loss : " + str(DETECT_ON_TRACKING_LOSS))
     logging.info("Rescale image detection size : " + str(DETECTION_SIZE))
+    logging.info("Tiled detection : " + str(TILED_DETECTION) + ", tile size " + str(TILE_SIZE))
     logging.info("Classifications : " + str(SHOW_ONLY) + " * if empty all detections are allowed.")
     logging.info("Screen size : " + str(WIDTH) + "x" + str(HEIGHT))
     logging.info("Screen offset : " + str(OFFSET))
     logging.info("Average amount of red : " + str(RED_NUMBER))
+    logging.info("Zero-copy capture : " + str(ZERO_COPY_CAPTURE))
+    logging.info("Max capture rate : " + str(CAPTURE_FPS) + " fps")
+    logging.info("Screen change threshold : " + str(CHANGE_THRESHOLD))
+    logging.info("Replay : " + str(REPLAY_FILE) + " at speed " + str(REPLAY_SPEED) + ", record : " + str(RECORD_FILE))
+    logging.info("B-scan source : " + str(BSCAN_SOURCE) + ", colour scale : " + str(BSCAN_RANGE))
+    logging.info("Metrics file : " + str(METRICS_FILE) + ", shown in overlay : " + str(SHOW_METRICS))
     logging.info("")
 
     logging.info("")
@@ -166,7 +374,8 @@ if __name__ == "__main__":
     logging.info("Exit by typing : 'ctrl+c'")
     logging.info("")
 
-    app = QApplication([])
+    with startup_timer.phase("Qt application"):
+        app = QApplication([])
 
     MainGUI()
 
@@ -2,10 +2,12 @@
 Abstract Object Detector Class
 """
 import math
+import time
 
-from utils import screen_overlay_handler
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 
 class Detector(ABC):
 
@@ -28,6 +30,8 @@ class Detector(ABC):
 
     #  creates tracking box
     def create_new_tracking_box(self, scores, c, shared_variables, box):
+        from utils import screen_overlay_handler  # Qt is only needed with the overlay
+
         shared_variables.trackingboxes.append(screen_overlay_handler.TrackingBox(scores, c, shared_variables, box))
 
     @abstractmethod
@@ -41,3 +45,25 @@ class Detector(ABC):
     @abstractmethod
     def predict(self, image):
         pass
+
+    # Runs detection on a single image and returns its detections
+    @abstractmethod
+    def detect(self, image):
+        pass
+
+    # Runs detection on several images and returns a list of detections per image.
+    # timing(stage, seconds), if given, is called for every frame in order with the time of its 'preprocess',
+    # 'inference' and 'postprocess' stage. Subclasses that can stack frames into one forward pass should override
+    # this, here the whole detection counts as inference
+    def predict_batch(self, frames, batch_size=None, timing=None):
+        detections = []
+        for frame in frames:
+            start = time.perf_counter()
+            detections.append(self.detect(frame))
+            if timing is not None:
+                timing('inference', time.perf_counter() - start)
+        return detections
+
+    # Runs one detection on a blank frame of the given shape to trigger lazy initialization
+    def warm_up(self, shape):
+        self.detect(np.zeros(shape, dtype=np.uint8))
@@ -0,0 +1,192 @@
+"""
+This file contains YOLO class running an exported model with ONNX Runtime or OpenVINO on the CPU
+"""
+
+from ml.torch import yolo
+from ml import tiling
+
+import ast
+import os
+import logging
+import time
+
+import numpy as np
+import cv2
+
+BACKENDS = ('torch', 'onnx', 'onnx-int8', 'openvino')  # values of MODEL_BACKEND, all but torch run here
+
+
+class YOLO(yolo.YOLO):
+    WEIGHTS = 'best.pt'
+    IMAGE_SIZE = 640  # model input size
+    STRIDE = 32  # model stride, the minimal rectangle padding keeps the input a multiple of it
+    PREPROCESSING = 'ultralytics-8.0'  # stored in quantized models, calibration depends on the letterbox
+    CONFIDENCE = 0.25  # boxes below are dropped before NMS, same default as ultralytics
+    MAX_DETECTIONS = 300
+
+    def __init__(self, shared_variables):
+        super().__init__(shared_variables)
+        if shared_variables.MODEL_BACKEND not in BACKENDS[1:]:
+            raise ValueError(f"Unknown exported model backend {shared_variables.MODEL_BACKEND!r}, "
+                             f"expected one of {', '.join(BACKENDS[1:])}")
+        self.backend = 'openvino' if shared_variables.MODEL_BACKEND == 'openvino' else 'onnx'
+        self.quantized = shared_variables.MODEL_BACKEND == 'onnx-int8'  # model made by quantizeModel.py
+        self.threads = shared_variables.INFERENCE_THREADS  # intra-op threads, 0 - runtime default
+        self.model_path = None
+        self.names = {}
+
+    # Returns the path of the exported model for weights
+    @staticmethod
+    def exported_path(weights, backend, quantized=False):
+        base = os.path.splitext(weights)[0]
+        if backend == 'openvino':
+            return os.path.join(base + '_openvino_model', os.path.basename(base) + '.xml')
+        if quantized:
+            return base + '.int8.onnx'
+        return base + '.onnx'
+
+    # Exports weights once, the export is reused until the weights change
+    def download_model(self, weights=WEIGHTS):
+        self.model_path = self.exported_path(weights, self.backend, self.quantized)
+        if self.quantized:
+            if not os.path.exists(self.model_path):
+                raise FileNotFoundError(f"{self.model_path} not found, create it with "
+                                        f"singleImageDetection/quantizeModel.py")
+            return
+
+        if os.path.exists(self.model_path) and os.path.getmtime(self.model_path) >= os.path.getmtime(weights):
+            logging.info(f"Using exported model {self.model_path}")
+            return
+
+        from ultralytics import YOLO as y  # only needed for the export
+
+        logging.info(f"Exporting {weights} to {self.backend}, this happens once")
+        exported = y(weights).export(format=self.backend, imgsz=self.IMAGE_SIZE, dynamic=True)
+        if self.backend == 'onnx':
+            self.model_path = exported
+
+    def load_model(self, model_path=None):
+        # Load model
+        model_path = model_path or self.model_path or self.exported_path(self.WEIGHTS, self.backend, self.quantized)
+
+        if self.backend == 'openvino':
+            from openvino.runtime import Core
+            import yaml
+
+            config = {'INFERENCE_NUM_THREADS': str(self.threads)} if self.threads > 0 else {}
+            self.model = Core().compile_model(model_path, 'CPU', config)
+            self.output = self.model.output(0)
+
+            # Class names are stored by the export next to the model
+            with open(os.path.join(os.path.dirname(model_path), 'metadata.yaml')) as file:
+                self.names = yaml.safe_load(file)['names']
+        else:
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if self.threads > 0:
+                options.intra_op_num_threads = self.threads
+            self.model = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+            self.input_name = self.model.get_inputs()[0].name
+
+            # Class names are stored by the export in the model metadata
+            metadata = self.model.get_modelmeta().custom_metadata_map
+            self.names = ast.literal_eval(metadata['names'])
+
+            # Models calibrated with another preprocessing quantize the wrong value ranges
+            if self.quantized and metadata.get('preprocessing') != self.PREPROCESSING:
+                raise ValueError(f"{model_path} was calibrated with an older preprocessing, create it again with "
+                                 f"singleImageDetection/quantizeModel.py")
+
+        self.names = {int(class_id): name for class_id, name in self.names.items()}
+        self.shared_variables.detection_ready = True
+
+    # Prepares an image the way ultralytics does for best.pt: resizes it keeping its aspect ratio, pads it to
+    # the minimal rectangle of STRIDE multiples (rectangle False - to the square model input size) and flips
+    # the channels, ultralytics expects BGR numpy input. Frames are passed in the same channel order as to
+    # the PyTorch detector, so both models see the same tensor.
+    # Returns the CHW float image, the scale and the (x, y) padding
+    def letterbox(self, image, rectangle=True):
+        height, width = image.shape[:2]
+        scale = min(self.IMAGE_SIZE / height, self.IMAGE_SIZE / width)
+        new_width, new_height = round(width * scale), round(height * scale)
+        pad_x, pad_y = self.IMAGE_SIZE - new_width, self.IMAGE_SIZE - new_height
+        if rectangle:
+            pad_x, pad_y = pad_x % self.STRIDE, pad_y % self.STRIDE
+        pad_x, pad_y = pad_x / 2, pad_y / 2
+
+        if (width, height) != (new_width, new_height):
+            image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+        top, left = round(pad_y - 0.1), round(pad_x - 0.1)
+        padded = cv2.copyMakeBorder(image, top, round(pad_y + 0.1), left, round(pad_x + 0.1),
+                                    cv2.BORDER_CONSTANT, value=(114, 114, 114))
+
+        tensor = np.ascontiguousarray(padded[..., ::-1].transpose(2, 0, 1), dtype=np.float32)
+        tensor /= 255
+        return tensor, scale, (left, top)
+
+    # Runs the exported model on a (n, 3, height, width) batch, returns (n, 4 + classes, boxes)
+    def infer(self, batch):
+        if self.backend == 'openvino':
+            return self.model(batch)[self.output]
+        return self.model.run(None, {self.input_name: batch})[0]
+
+    # Decodes the raw output of one image like ultralytics, applies NMS and the same filters as the PyTorch detector
+    def postprocess(self, output, image, scale, padding):
+        predictions = output.T  # (boxes, 4 + classes)
+        class_ids = predictions[:, 4:].argmax(axis=1)
+        scores = predictions[np.arange(len(predictions)), 4 + class_ids]
+
+        mask = scores > self.CONFIDENCE
+        boxes = predictions[mask, :4].astype(np.float64)
+        scores = scores[mask].astype(np.float64)
+        class_ids = class_ids[mask]
+
+        # Center boxes to corners for NMS
+        xyxy = np.concatenate([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], axis=1)
+        keep = tiling.nms(xyxy, scores, class_ids, self.NMS_IOU)[:self.MAX_DETECTIONS]
+        scores, class_ids = scores[keep], class_ids[keep]
+
+        # Undo the letterbox and clip to the image, boxes become center x, y, width, height in image pixels
+        height, width = image.shape[:2]
+        xyxy = xyxy[keep]
+        xyxy[:, [0, 2]] = np.clip((xyxy[:, [0, 2]] - padding[0]) / scale, 0, width)
+        xyxy[:, [1, 3]] = np.clip((xyxy[:, [1, 3]] - padding[1]) / scale, 0, height)
+        xywh = np.concatenate([(xyxy[:, :2] + xyxy[:, 2:]) / 2, xyxy[:, 2:] - xyxy[:, :2]], axis=1)
+        xywhn = xywh / np.array([width, height, width, height], dtype=np.float64)
+
+        return self.filter_detections(image, xywhn, xywh, scores, class_ids, self.names)
+
+    # Runs the model on an image and filters the results
+    def detect(self, image):
+        return self.predict_batch([image])[0]
+
+    # Stacks letterboxed frames into batches of batch_size (all at once by default). Like ultralytics, frames
+    # of one shape get the minimal rectangle padding, frames of different shapes the square one.
+    # Letterbox and forward pass times of a batch are shared by its frames
+    def predict_batch(self, frames, batch_size=None, timing=None):
+        frames = list(frames)
+        batch_size = batch_size or max(1, len(frames))
+
+        detections = []
+        for start in range(0, len(frames), batch_size):
+            images = frames[start:start + batch_size]
+            stage_start = time.perf_counter()
+            rectangle = all(image.shape == images[0].shape for image in images)
+            prepared = [self.letterbox(image, rectangle) for image in images]
+            batch = np.stack([tensor for tensor, _, _ in prepared])
+            preprocess = (time.perf_counter() - stage_start) / len(images)
+
+            stage_start = time.perf_counter()
+            outputs = self.infer(batch)
+            inference = (time.perf_counter() - stage_start) / len(images)
+
+            for output, image, (_, scale, padding) in zip(outputs, images, prepared):
+                stage_start = time.perf_counter()
+                detections.append(self.postprocess(output, image, scale, padding))
+                if timing is not None:
+                    timing('preprocess', preprocess)
+                    timing('inference', inference)
+                    timing('postprocess', time.perf_counter() - stage_start)
+
+        return detections
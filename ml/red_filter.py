@@ -0,0 +1,51 @@
+"""
+This file contains the red colour filter used to check detected boxes on radargrams
+"""
+
+import numpy as np
+import cv2
+
+
+# Checks the average colour of many boxes on one RGB image using summed-area tables.
+# The tables are built once per frame, after that every box costs four lookups per channel
+class RedFilter:
+
+    def __init__(self, red_number=240):
+        self.red_number = red_number  # minimum average red value
+        self.table = None  # summed-area table, (h + 1, w + 1, channels)
+
+    # Builds the summed-area tables for a new frame
+    def set_frame(self, image):
+        self.table = cv2.integral(image, sdepth=cv2.CV_64F)
+
+    # Returns the average colour of every box as an (n, channels) array, nan for empty boxes
+    def mean_colors(self, x1, y1, x2, y2):
+        h, w = self.table.shape[0] - 1, self.table.shape[1] - 1
+
+        # Clip boxes to the image
+        x1 = np.clip(np.asarray(x1, dtype=int), 0, w)
+        y1 = np.clip(np.asarray(y1, dtype=int), 0, h)
+        x2 = np.clip(np.asarray(x2, dtype=int), 0, w)
+        y2 = np.clip(np.asarray(y2, dtype=int), 0, h)
+
+        sums = self.table[y2, x2] - self.table[y1, x2] - self.table[y2, x1] + self.table[y1, x1]
+        area = (np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)).astype(np.float64)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / area[:, None]
+        means[area == 0] = np.nan
+        return means
+
+    # True for every box whose average red exceeds red_number and dominates green and blue
+    def mask(self, x1, y1, x2, y2):
+        means = self.mean_colors(x1, y1, x2, y2)
+        red_avg, green_avg, blue_avg = means[:, 0], means[:, 1], means[:, 2]
+
+        # nan (empty boxes) compares as False
+        return (red_avg >= self.red_number) & (red_avg > green_avg) & (red_avg > blue_avg)
+
+    # Builds the tables for an image and checks (n, 4) boxes given as x1, y1, x2, y2 pixels
+    def filter(self, image, xyxy):
+        self.set_frame(image)
+        xyxy = np.asarray(xyxy).reshape(-1, 4).astype(int)
+        return self.mask(xyxy[:, 0], xyxy[:, 1], xyxy[:, 2], xyxy[:, 3])
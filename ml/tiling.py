@@ -0,0 +1,70 @@
+"""
+This file contains helpers for running detection on overlapping tiles of a high resolution frame
+"""
+
+import numpy as np
+
+
+# Returns start positions of tiles of size tile covering length with the given overlap fraction
+def tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+
+    stride = max(1, int(tile * (1 - overlap)))
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)  # last tile ends at the border
+    return starts
+
+
+# Splits an image into overlapping tiles (views, no copies) and returns them with their (x, y) origins
+def make_tiles(image, tile_size=640, overlap=0.2):
+    height, width = image.shape[:2]
+    tiles, origins = [], []
+    for y in tile_starts(height, tile_size, overlap):
+        for x in tile_starts(width, tile_size, overlap):
+            tiles.append(image[y:y + tile_size, x:x + tile_size])
+            origins.append((x, y))
+    return tiles, origins
+
+
+# Non-maximum suppression of (n, 4) x1, y1, x2, y2 boxes, only boxes of the same class suppress each other.
+# metric 'ios' divides the intersection by the smaller box instead of the union, so a box cut by a tile
+# border is merged into the full box from the neighbouring tile. With tile_ids the metric only applies to boxes
+# of different tiles, boxes of the same tile compare by IoU against same_tile_iou (default iou_threshold), so a
+# small object inside a larger one is kept. Returns indices of kept boxes, highest score first
+def nms(boxes, scores, class_ids, iou_threshold=0.5, metric='iou', tile_ids=None, same_tile_iou=None):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return []
+
+    # Shift every class to its own region so boxes of different classes never overlap
+    offset = (boxes.max() + 1) * np.asarray(class_ids, dtype=np.float64)[:, None]
+    boxes = boxes + offset
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    if tile_ids is not None:
+        tile_ids = np.asarray(tile_ids)
+        same_tile_iou = iou_threshold if same_tile_iou is None else same_tile_iou
+
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    keep = []
+    while len(order) > 0:
+        best, rest = order[0], order[1:]
+        keep.append(int(best))
+
+        # IoU of the best box with all remaining boxes at once
+        x1 = np.maximum(boxes[best, 0], boxes[rest, 0])
+        y1 = np.maximum(boxes[best, 1], boxes[rest, 1])
+        x2 = np.minimum(boxes[best, 2], boxes[rest, 2])
+        y2 = np.minimum(boxes[best, 3], boxes[rest, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = areas[best] + areas[rest] - intersection
+        denominator = np.minimum(areas[best], areas[rest]) if metric == 'ios' else union
+        with np.errstate(invalid='ignore', divide='ignore'):
+            overlap = intersection / denominator
+            suppressed = overlap > iou_threshold
+            if tile_ids is not None:
+                same_tile = tile_ids[rest] == tile_ids[best]
+                suppressed[same_tile] = intersection[same_tile] / union[same_tile] > same_tile_iou
+
+        order = rest[~suppressed]
+    return keep
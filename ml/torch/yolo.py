@@ -3,87 +3,177 @@ This file contains YOLO class used for object detection
 """
 
 from ml import detector as d
-from ultralytics import YOLO as y
+from ml.red_filter import RedFilter
+from ml import tiling
+from utils.change_detector import ChangeDetector
 import numpy as np
+import time
 
 
 class YOLO(d.Detector):
+    NMS_IOU = 0.7  # IoU threshold of the model's own NMS, the ultralytics default
+
     def __init__(self, shared_variables):
         self.shared_variables = shared_variables
+        self.last_sequence = 0  # sequence number of the last frame sent to the model
+        self.class_filter_key = None
+        self.class_filter = set()
+        self.red_filter = RedFilter(shared_variables.RED_NUMBER)
+        self.change_detector = ChangeDetector()
+        self.detections = []  # detections of the last inferred frame
+        self.unchanged = False  # last predict did not run the model: no new frame or the screen did not change
 
     def download_model(self):
         pass
 
-    def load_model(self):
+    def load_model(self, model_path='best.pt'):
+        from ultralytics import YOLO as y  # imports torch, deferred until the model is needed
+
         # Load model
-        self.model = y('best.pt')
+        self.model = y(model_path)
         self.shared_variables.detection_ready = True
 
+    # Returns the detections of the latest frame, None if there is nothing new to associate
     def predict(self):
-        # Receives image for further predictions
-        image = self.shared_variables.OutputFrame
-
+        # Receives the latest frame and keeps it pinned in the frame ring during prediction
+        with self.shared_variables.frame_ring.read_latest() as frame:
+            # Nothing captured yet or this frame was already processed
+            if frame is None or frame.sequence == self.last_sequence:
+                self.unchanged = True
+                return None
+
+            self.last_sequence = frame.sequence
+            metrics = self.shared_variables.metrics
+            metrics.histogram('frame_age_ms').observe(1000 * frame.age())
+
+            # Screen did not change since the last inference, its detections were already associated
+            self.change_detector.threshold = self.shared_variables.CHANGE_THRESHOLD
+            self.unchanged = not self.change_detector.changed(frame.image)
+            if self.unchanged:
+                return None
+
+            if self.shared_variables.TILED_DETECTION:
+                self.detections = self.detect_tiled(frame.image)
+            else:
+                self.detections = self.detect(frame.image)
+            metrics.gauge('detected_boxes').set(len(self.detections))  # after all filters
+            return self.detections
+
+    # Returns the set of class ids whose names are in SHOW_ONLY, recomputed only when SHOW_ONLY changes
+    def allowed_class_ids(self, names):
+        key = (id(names), tuple(self.shared_variables.SHOW_ONLY))
+        if self.class_filter_key != key:
+            self.class_filter_key = key
+            self.class_filter = {class_id for class_id, name in names.items() if name in key[1]}
+        return self.class_filter
+
+    # Applies score, class, area and red ROI filters to all boxes at once and returns a boolean mask
+    def filter_boxes(self, image, xywhn, xywh, scores, class_ids, names):
+        if len(self.shared_variables.SHOW_ONLY) > 0:
+            # Check if precision is more than predefined threshold and the class is allowed
+            keep = scores >= self.shared_variables.PRECISION
+            keep &= np.isin(class_ids, list(self.allowed_class_ids(names)))
+        else:
+            keep = scores > self.shared_variables.PRECISION
+
+        keep &= xywh[:, 2] * xywh[:, 3] <= self.shared_variables.MAX_BOX_AREA
+
+        if keep.any():
+            # Convert normalized coordinates of the remaining boxes to actual image coordinates
+            h, w, _ = image.shape
+            boxes = xywhn[keep]
+            x1 = ((boxes[:, 0] - boxes[:, 2] / 2) * w).astype(int)
+            y1 = ((boxes[:, 1] - boxes[:, 3] / 2) * h).astype(int)
+            x2 = ((boxes[:, 0] + boxes[:, 2] / 2) * w).astype(int)
+            y2 = ((boxes[:, 1] + boxes[:, 3] / 2) * h).astype(int)
+
+            # Check if the average red color of the ROI exceeds a predefined threshold
+            self.red_filter.red_number = self.shared_variables.RED_NUMBER
+            self.red_filter.set_frame(image)
+            keep[keep] = self.red_filter.mask(x1, y1, x2, y2)
+
+        return keep
+
+    # Filters the boxes of one model result and returns (score, classification, box) tuples
+    def process_result(self, obj, image):
+        classes = obj.names
+        if len(obj.boxes) == 0:
+            return []
+
+        # Pull all boxes out of the model output once
+        xywhn = obj.boxes.xywhn.cpu().numpy().astype(np.float64)
+        xywh = obj.boxes.xywh.cpu().numpy().astype(np.float64)
+        scores = obj.boxes.conf.cpu().numpy().astype(np.float64)
+        class_ids = obj.boxes.cls.cpu().numpy().astype(int)
+
+        return self.filter_detections(image, xywhn, xywh, scores, class_ids, classes)
+
+    # Filters box arrays of one image and returns (score, classification, box) tuples
+    def filter_detections(self, image, xywhn, xywh, scores, class_ids, names):
+        keep = self.filter_boxes(image, xywhn, xywh, scores, class_ids, names)
+
+        return [(float(scores[i]), names[class_ids[i]], tuple(xywhn[i].tolist())) for i in np.flatnonzero(keep)]
+
+    # Runs the model on an image and filters the results
+    def detect(self, image):
         # Performs prediction
         results = self.model.predict(image)
 
         # Access detected objects and their attributes
         detected_objects = []
-
         for obj in results:
-            classes = obj.names
-            for i in range(len(obj.boxes.cls.tolist())):
-                _box = obj.boxes.xywhn.tolist()[i]
-
-                # Convert normalized coordinates to actual image coordinates
-                h, w, _ = image.shape
-                x1 = int((_box[0] - _box[2] / 2) * w)
-                y1 = int((_box[1] - _box[3] / 2) * h)
-                x2 = int((_box[0] + _box[2] / 2) * w)
-                y2 = int((_box[1] + _box[3] / 2) * h)
-
-                box = (_box[0], _box[1], _box[2], _box[3])
-
-                score = obj.boxes.conf.tolist()[i]
-                classification = obj.boxes.cls.tolist()[i]
-
-                __box = obj.boxes.xywh.tolist()[i]
-
-                # Apply filters
-                if len(self.shared_variables.SHOW_ONLY) > 0:
-                    # Check if precision is more than predefined threshold
-                    if score >= self.shared_variables.PRECISION:
-                        if classes[classification] in self.shared_variables.SHOW_ONLY:
-                            if __box[2] * __box[3] <= self.shared_variables.MAX_BOX_AREA:
-                                # Extract ROI
-                                roi = image[y1:y2, x1:x2]
-
-                                # Check average color of ROI
-                                avg_color_per_row = np.average(roi, axis=0)
-                                avg_color = np.average(avg_color_per_row, axis=0)
-                                red_avg, green_avg, blue_avg = avg_color
-
-                                # Check if the average red color exceeds a predefined threshold
-                                if (red_avg >= self.shared_variables.RED_NUMBER
-                                        and red_avg > green_avg
-                                        and red_avg > blue_avg):
-                                    detected_objects.append((score, classes[classification], box))
-
-                else:
-                    # Check if precision is more than predefined threshold
-                    if score > self.shared_variables.PRECISION:
-                        if __box[2] * __box[3] <= self.shared_variables.MAX_BOX_AREA:
-                            # Extract ROI
-                            roi = image[y1:y2, x1:x2]
-
-                            # Check average color of ROI
-                            avg_color_per_row = np.average(roi, axis=0)
-                            avg_color = np.average(avg_color_per_row, axis=0)
-                            red_avg, green_avg, blue_avg = avg_color
-
-                            # Check if the average red color exceeds a predefined threshold
-                            if (red_avg >= self.shared_variables.RED_NUMBER
-                                    and red_avg > green_avg
-                                    and red_avg > blue_avg):
-                                detected_objects.append((score, classes[classification], box))
+            detected_objects.extend(self.process_result(obj, image))
+
+        return detected_objects
+
+    # Stacks frames into batches of batch_size (all at once by default) and returns detections per frame.
+    # Letterbox, forward pass and NMS are timed by ultralytics, the filters count as postprocess
+    def predict_batch(self, frames, batch_size=None, timing=None):
+        frames = list(frames)
+        batch_size = batch_size or max(1, len(frames))
+
+        detections = []
+        for start in range(0, len(frames), batch_size):
+            batch = frames[start:start + batch_size]
+
+            # One forward pass for the whole batch, results come back in input order
+            results = self.model.predict(batch, verbose=False)
+            for obj, image in zip(results, batch):
+                start_filter = time.perf_counter()
+                detections.append(self.process_result(obj, image))
+                if timing is not None:
+                    timing('preprocess', obj.speed['preprocess'] / 1000)  # milliseconds per image
+                    timing('inference', obj.speed['inference'] / 1000)
+                    timing('postprocess', obj.speed['postprocess'] / 1000 + time.perf_counter() - start_filter)
+
+        return detections
+
+    # Runs the model on overlapping full resolution tiles in one batch, maps boxes back to the frame
+    # and merges duplicates found on both sides of a tile seam
+    def detect_tiled(self, image):
+        tiles, origins = tiling.make_tiles(image, self.shared_variables.TILE_SIZE, self.shared_variables.TILE_OVERLAP)
+
+        boxes, scores, names, tile_ids = [], [], [], []
+        for tile_id, (tile, (x, y), detections) in enumerate(zip(tiles, origins, self.predict_batch(tiles))):
+            tile_height, tile_width = tile.shape[:2]
+            for score, classification, box in detections:
+                # Normalized tile coordinates to frame pixels (x1, y1, x2, y2)
+                boxes.append(((box[0] - box[2] / 2) * tile_width + x, (box[1] - box[3] / 2) * tile_height + y,
+                              (box[0] + box[2] / 2) * tile_width + x, (box[1] + box[3] / 2) * tile_height + y))
+                scores.append(score)
+                names.append(classification)
+                tile_ids.append(tile_id)
+
+        class_ids = {name: i for i, name in enumerate(set(names))}
+        keep = tiling.nms(boxes, scores, [class_ids[name] for name in names], self.shared_variables.TILE_NMS_IOU,
+                          metric='ios', tile_ids=tile_ids, same_tile_iou=self.NMS_IOU)
+
+        # Back to normalized frame coordinates like the untiled detection
+        height, width = image.shape[:2]
+        detected_objects = []
+        for i in keep:
+            x1, y1, x2, y2 = boxes[i]
+            box = ((x1 + x2) / 2 / width, (y1 + y2) / 2 / height, (x2 - x1) / width, (y2 - y1) / height)
+            detected_objects.append((scores[i], names[i], box))
 
         return detected_objects
@@ -0,0 +1,255 @@
+"""
+This file runs the detection of the real-time overlay (model, class, area and red colour filters) over a directory
+of images without a GUI. It writes detections per image to CSV/JSON and reports throughput, stage latencies and
+peak memory.
+
+Example: python batchDetection.py --images testImages --weights best.pt --csv detections.csv --json detections.json
+         python batchDetection.py --images testImages --weights best.pt --benchmark-csv benchmark.csv
+         python batchDetection.py --images testImages --backend onnx --show-only
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import cv2
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+# Allow imports from the project root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ml.torch import yolo as torch_yolo  # noqa: E402
+from ml.onnx import yolo as onnx_yolo  # noqa: E402
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+STAGES = ('decode', 'preprocess', 'inference', 'postprocess')
+
+
+# Detection settings, same names and defaults as the shared variables of the real-time detection
+class Settings:
+    PRECISION = 0.3
+    SHOW_ONLY = ["FMCW-Radar-Output"]  # empty - all classes
+    MAX_BOX_AREA = 100000000
+    RED_NUMBER = 240
+    DETECTION_SIZE = 640
+    MODEL_BACKEND = 'torch'
+    INFERENCE_THREADS = 0
+    detection_ready = False
+
+
+# Reads and prepares one image, returns it with the time spent in each stage
+def load_image(path, detection_size):
+    start = time.perf_counter()
+    image = cv2.imread(path)
+    decoded = time.perf_counter()
+
+    if image is not None:
+        # Same colour order and downscaling as the screen capture
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        height, width, _ = image.shape
+        if detection_size and height > detection_size:
+            scale = height / detection_size
+            image = cv2.resize(image, (int(width / scale), int(height / scale)))
+
+    return image, decoded - start, time.perf_counter() - decoded
+
+
+# Returns the image paths of a directory sorted by name
+def list_images(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+# Yields (path, image, decode time, preprocess time), decoding ahead in a worker pool
+def stream_images(paths, workers, detection_size):
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        paths = iter(paths)
+
+        # Keep a bounded number of images in flight
+        for path in paths:
+            pending.append((path, pool.submit(load_image, path, detection_size)))
+            if len(pending) >= 2 * workers:
+                break
+
+        while pending:
+            path, future = pending.popleft()
+            next_path = next(paths, None)
+            if next_path is not None:
+                pending.append((next_path, pool.submit(load_image, next_path, detection_size)))
+            yield (path,) + future.result()
+
+
+# Returns peak resident memory of this process in MB, None if unknown
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB on Linux
+
+
+# Returns p50/p90/p99/max of latencies in milliseconds
+def percentiles(values):
+    if len(values) == 0:
+        return {}
+    values = 1000 * np.asarray(values)
+    return {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+            'p99': float(np.percentile(values, 99)), 'max': float(values.max())}
+
+
+# Returns the time the detector reported for the stage of the image at index, 0 if it did not time the stage
+def stage_time(measured, stage, index):
+    return measured[stage][index] if index < len(measured[stage]) else 0.0
+
+
+# Runs the detection over all images and returns detections per image and benchmark results
+def run(detector, paths, batch_size=4, workers=4, detection_size=640):
+    detections = {}
+    latencies = {stage: [] for stage in STAGES}
+    start = time.perf_counter()
+
+    batch = []
+
+    # Same detection and filters as the overlay. The detector times its stages per image, its letterbox
+    # adds to the preprocessing of the image
+    def flush():
+        measured = {'preprocess': [], 'inference': [], 'postprocess': []}
+        results = detector.predict_batch([image for _, image, _ in batch],
+                                         timing=lambda stage, seconds: measured[stage].append(seconds))
+
+        for index, ((path, _, preprocess), boxes) in enumerate(zip(batch, results)):
+            detections[path] = boxes
+            latencies['preprocess'].append(preprocess + stage_time(measured, 'preprocess', index))
+            latencies['inference'].append(stage_time(measured, 'inference', index))
+            latencies['postprocess'].append(stage_time(measured, 'postprocess', index))
+        batch.clear()
+
+    for path, image, decode, preprocess in stream_images(paths, workers, detection_size):
+        latencies['decode'].append(decode)
+        if image is None:
+            logging.warning(f"Could not read {path}")
+            continue
+
+        batch.append((path, image, preprocess))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - start
+    benchmark = {
+        'images': len(detections),
+        'seconds': elapsed,
+        'images_per_second': len(detections) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {stage: percentiles(latencies[stage]) for stage in STAGES},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    return detections, benchmark
+
+
+# Writes one row per detection
+def write_csv(path, detections):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['image', 'score', 'classification', 'x', 'y', 'width', 'height'])
+        for image, boxes in detections.items():
+            for score, classification, box in boxes:
+                writer.writerow([os.path.basename(image), score, classification] + list(box))
+
+
+# Writes one row of latency percentiles per stage, with throughput and peak memory
+def write_benchmark_csv(path, benchmark):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['stage', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'images', 'images_per_second',
+                         'peak_rss_mb'])
+        for stage in STAGES:
+            stats = benchmark['latency_ms'][stage]
+            writer.writerow([stage] + [stats.get(key) for key in ('p50', 'p90', 'p99', 'max')] +
+                            [benchmark['images'], benchmark['images_per_second'], benchmark['peak_rss_mb']])
+
+
+# Writes detections per image together with the benchmark results
+def write_json(path, detections, benchmark):
+    with open(path, 'w') as file:
+        json.dump({'benchmark': benchmark,
+                   'detections': {os.path.basename(image): [{'score': score, 'classification': classification,
+                                                             'box': list(box)}
+                                                            for score, classification, box in boxes]
+                                  for image, boxes in detections.items()}}, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch YOLO detection and benchmark over a directory of images')
+    parser.add_argument('--images', default='testImages', help='directory with images')
+    parser.add_argument('--weights', default='best.pt', help='YOLO weights')
+    parser.add_argument('--backend', choices=onnx_yolo.BACKENDS, default=Settings.MODEL_BACKEND,
+                        help='model backend, the others run a model exported from the weights')
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads of the onnx/openvino backends')
+    parser.add_argument('--csv', help='CSV file for detections')
+    parser.add_argument('--json', help='JSON file for detections and benchmark')
+    parser.add_argument('--benchmark-csv', help='CSV file for the stage latencies and throughput')
+    parser.add_argument('--batch-size', type=int, default=4, help='images per forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='threads for decoding and preprocessing')
+    parser.add_argument('--detection-size', type=int, default=Settings.DETECTION_SIZE,
+                        help='downscale images higher than this, 0 keeps full size')
+    parser.add_argument('--precision', type=float, default=Settings.PRECISION, help='detection threshold')
+    parser.add_argument('--red-number', type=int, default=Settings.RED_NUMBER, help='average amount of red')
+    parser.add_argument('--show-only', nargs='*', default=Settings.SHOW_ONLY,
+                        help='classes to keep, without names all classes are kept')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+    settings = Settings()
+    settings.PRECISION = args.precision
+    settings.RED_NUMBER = args.red_number
+    settings.SHOW_ONLY = args.show_only
+    settings.MODEL_BACKEND = args.backend
+    settings.INFERENCE_THREADS = args.threads
+
+    if args.backend == 'torch':
+        detector = torch_yolo.YOLO(settings)
+        detector.load_model(args.weights)
+    else:
+        detector = onnx_yolo.YOLO(settings)
+        detector.download_model(args.weights)
+        detector.load_model()
+
+    paths = list_images(args.images)
+    logging.info(f"Running {args.backend} detection of {args.show_only or 'all classes'} on {len(paths)} images "
+                 f"from {args.images}")
+    detections, benchmark = run(detector, paths, args.batch_size, args.workers, args.detection_size)
+
+    if args.csv:
+        write_csv(args.csv, detections)
+    if args.json:
+        write_json(args.json, detections, benchmark)
+    if args.benchmark_csv:
+        write_benchmark_csv(args.benchmark_csv, benchmark)
+
+    logging.info(f"Images : {benchmark['images']} in {benchmark['seconds']:.2f} s "
+                 f"({benchmark['images_per_second']:.2f} images/s)")
+    for stage in STAGES:
+        stats = benchmark['latency_ms'][stage]
+        if stats:
+            logging.info(f"{stage:<12} p50 {stats['p50']:.1f} ms  p90 {stats['p90']:.1f} ms  "
+                         f"p99 {stats['p99']:.1f} ms  max {stats['max']:.1f} ms")
+    logging.info(f"Peak RSS : {benchmark['peak_rss_mb']} MB")
+    logging.info(f"Detections : {sum(len(boxes) for boxes in detections.values())}")
+
+
+if __name__ == '__main__':
+    main()
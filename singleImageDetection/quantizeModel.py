@@ -0,0 +1,180 @@
+"""
+This file quantizes the trained YOLO model to INT8 with ONNX Runtime, calibrated on a directory of radargrams,
+and compares the quantized model with the FP32 best.pt on the same images.
+The result (best.int8.onnx) is loaded by main.py with MODEL_BACKEND = "onnx-int8".
+
+Example: python quantizeModel.py --images testImages --weights best.pt --report quantization.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import onnx
+from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, \
+    quantize_static
+
+# Allow imports from the project root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from batchDetection import Settings, list_images, load_image, percentiles  # noqa: E402
+from ml.onnx import yolo as onnx_yolo  # noqa: E402
+from ml.torch import yolo as torch_yolo  # noqa: E402
+from utils.association import Associator  # noqa: E402
+
+
+# Settings of the ONNX detector
+class OnnxSettings(Settings):
+    MODEL_BACKEND = 'onnx'
+    INFERENCE_THREADS = 0
+
+
+# Feeds letterboxed calibration images to the ONNX Runtime calibrator
+class ImageCalibrationReader(CalibrationDataReader):
+
+    def __init__(self, paths, input_name, letterbox, detection_size):
+        self.paths = iter(paths)
+        self.input_name = input_name
+        self.letterbox = letterbox
+        self.detection_size = detection_size
+
+    def get_next(self):
+        for path in self.paths:
+            image, _, _ = load_image(path, self.detection_size)
+            if image is not None:
+                tensor, _, _ = self.letterbox(image)
+                return {self.input_name: tensor[None]}
+        return None
+
+
+# Quantizes an FP32 ONNX model to INT8. Nodes whose names start with one of exclude stay in FP32,
+# by default the detection head, which is sensitive to quantization
+def quantize(fp32_path, int8_path, paths, detector, detection_size, exclude=('/model.22/',)):
+    model = onnx.load(fp32_path)
+    input_name = model.graph.input[0].name
+    excluded = [node.name for node in model.graph.node if node.name.startswith(tuple(exclude))]
+    logging.info(f"Keeping {len(excluded)} nodes in FP32")
+
+    reader = ImageCalibrationReader(paths, input_name, detector.letterbox, detection_size)
+    quantize_static(fp32_path, int8_path, reader, quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    calibrate_method=CalibrationMethod.MinMax, nodes_to_exclude=excluded)
+
+    # Keep the class names the export stored in the model metadata, and record the preprocessing
+    # the model was calibrated with, the detector refuses models calibrated with another one
+    quantized = onnx.load(int8_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(prop for prop in model.metadata_props if prop.key != 'preprocessing')
+    quantized.metadata_props.add(key='preprocessing', value=detector.PREPROCESSING)
+    onnx.save(quantized, int8_path)
+
+
+# Runs a detector on every image, returns detections per image and latencies in seconds
+def run_detector(detector, images):
+    detections, latencies = [], []
+    for image in images:
+        start = time.perf_counter()
+        detections.append(detector.detect(image))
+        latencies.append(time.perf_counter() - start)
+    return detections, latencies
+
+
+# Converts (score, classification, normalized center box) tuples to top-left boxes for the associator
+def top_left_boxes(detections):
+    return [(box[0] - box[2] / 2, box[1] - box[3] / 2, box[2], box[3]) for _, _, box in detections]
+
+
+# Compares candidate detections with reference detections of the same images
+def compare(reference, candidate, iou_threshold=0.5):
+    associator = Associator(iou_threshold, cell_size=0.1)  # normalized coordinates
+    matched, score_deltas = 0, []
+    for reference_boxes, candidate_boxes in zip(reference, candidate):
+        matches, _, _ = associator.match(top_left_boxes(candidate_boxes), top_left_boxes(reference_boxes))
+        for detection, track in matches:
+            if candidate_boxes[detection][1] == reference_boxes[track][1]:
+                matched += 1
+                score_deltas.append(abs(candidate_boxes[detection][0] - reference_boxes[track][0]))
+
+    reference_count = sum(len(boxes) for boxes in reference)
+    candidate_count = sum(len(boxes) for boxes in candidate)
+    return {
+        'reference_detections': reference_count,
+        'detections': candidate_count,
+        'matched': matched,
+        'recall_vs_reference': matched / reference_count if reference_count else 1.0,
+        'precision_vs_reference': matched / candidate_count if candidate_count else 1.0,
+        'mean_score_delta': float(np.mean(score_deltas)) if score_deltas else 0.0,
+    }
+
+
+# Speed summary of one model
+def speed(latencies):
+    total = sum(latencies)
+    return {'images_per_second': len(latencies) / total if total > 0 else 0.0,
+            'latency_ms': percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='INT8 quantization of the YOLO model with an accuracy/speed report')
+    parser.add_argument('--images', default='testImages', help='directory with calibration images')
+    parser.add_argument('--weights', default='best.pt', help='FP32 YOLO weights')
+    parser.add_argument('--output', help='quantized model, default <weights>.int8.onnx')
+    parser.add_argument('--report', help='JSON file for the accuracy-vs-speed report')
+    parser.add_argument('--detection-size', type=int, default=Settings.DETECTION_SIZE,
+                        help='downscale images higher than this, 0 keeps full size')
+    parser.add_argument('--threads', type=int, default=0, help='ONNX Runtime intra-op threads, 0 - default')
+    parser.add_argument('--exclude', nargs='*', default=['/model.22/'],
+                        help='node name prefixes kept in FP32, nothing to quantize everything')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+
+    paths = list_images(args.images)
+    images = [image for image in (load_image(path, args.detection_size)[0] for path in paths) if image is not None]
+    logging.info(f"Using {len(images)} images from {args.images}")
+
+    settings = OnnxSettings()
+    settings.INFERENCE_THREADS = args.threads
+
+    # FP32 ONNX export, also used as the quantization input
+    detector = onnx_yolo.YOLO(settings)
+    detector.download_model(args.weights)
+    fp32_path = detector.model_path
+    int8_path = args.output or onnx_yolo.YOLO.exported_path(args.weights, 'onnx', quantized=True)
+
+    logging.info(f"Quantizing {fp32_path} to {int8_path}")
+    quantize(fp32_path, int8_path, paths, detector, args.detection_size, args.exclude)
+
+    # Reference: FP32 best.pt with PyTorch
+    reference = torch_yolo.YOLO(Settings())
+    reference.load_model(args.weights)
+    reference_detections, reference_latencies = run_detector(reference, images)
+
+    results = {'preprocessing': onnx_yolo.YOLO.PREPROCESSING, 'fp32_torch': speed(reference_latencies)}
+    for name, path in (('fp32_onnx', fp32_path), ('int8_onnx', int8_path)):
+        candidate = onnx_yolo.YOLO(settings)
+        candidate.load_model(path)
+        detections, latencies = run_detector(candidate, images)
+        results[name] = dict(speed(latencies), **compare(reference_detections, detections))
+
+    for name, result in results.items():
+        if name == 'preprocessing':
+            continue
+        line = f"{name:<11} {result['images_per_second']:.2f} images/s, p50 {result['latency_ms']['p50']:.1f} ms"
+        if 'recall_vs_reference' in result:
+            line += (f", recall {100 * result['recall_vs_reference']:.1f}%, "
+                     f"precision {100 * result['precision_vs_reference']:.1f}% vs best.pt, "
+                     f"mean score delta {result['mean_score_delta']:.3f}")
+        logging.info(line)
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,13 @@ This file is used for testing YOLO detection capabilities on a single image
 from ultralytics import YOLO
 import cv2
 import matplotlib.pyplot as plt
-import numpy as np
+import os
+import sys
+
+# Allow imports from the project root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ml.red_filter import RedFilter  # noqa: E402
 
 # Load model
 model = YOLO('best.pt')
@@ -21,23 +27,21 @@ image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
 # Make prediction
 results = model.predict(image)
 
+# Red colour filter shared with the real-time detection
+red_filter = RedFilter(240)
+
 # Show results
 for result in results:
-    for box in result.boxes:
-        x1, y1, x2, y2 = int(box.xyxy[0][0]), int(box.xyxy[0][1]), int(box.xyxy[0][2]), int(box.xyxy[0][3])
+    # Checking ROI average color of all boxes at once, summed-area tables are built before drawing
+    xyxy = result.boxes.xyxy.cpu().numpy().astype(int)
+    red = red_filter.filter(image, xyxy)
+
+    for box, (x1, y1, x2, y2), is_red in zip(result.boxes, xyxy, red):
         confidence = box.conf[0]
         class_id = int(box.cls[0])
 
-        # Cutting ROI for color check
-        roi = image[y1:y2, x1:x2]
-
-        # Checking ROI average color
-        avg_color_per_row = np.average(roi, axis=0)
-        avg_color = np.average(avg_color_per_row, axis=0)
-        red_avg, green_avg, blue_avg = avg_color
-
         # If amount of red exceeds threshold
-        if red_avg >= 240 and red_avg > green_avg and red_avg > blue_avg:
+        if is_red:
             # Draw rectangle around detected object
             cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 255), 2)
             cv2.putText(image, f'{model.names[class_id]}: {confidence:.2f}', (x1, y1 - 10),
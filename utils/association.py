@@ -0,0 +1,86 @@
+"""
+This file matches new detections to already tracked objects using a grid index and IoU
+"""
+
+import numpy as np
+
+
+# Returns IoU of box pairs given as (n, 4) arrays of x, y, width, height
+def iou(boxes1, boxes2):
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+
+    x1 = np.maximum(boxes1[:, 0], boxes2[:, 0])
+    y1 = np.maximum(boxes1[:, 1], boxes2[:, 1])
+    x2 = np.minimum(boxes1[:, 0] + boxes1[:, 2], boxes2[:, 0] + boxes2[:, 2])
+    y2 = np.minimum(boxes1[:, 1] + boxes1[:, 3], boxes2[:, 1] + boxes2[:, 3])
+
+    intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    union = boxes1[:, 2] * boxes1[:, 3] + boxes2[:, 2] * boxes2[:, 3] - intersection
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(union > 0, intersection / union, 0.0)
+
+
+# Buckets boxes into grid cells so only nearby boxes are compared
+class GridIndex:
+
+    def __init__(self, boxes, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}
+        for index, box in enumerate(boxes):
+            for cell in self.box_cells(box):
+                self.cells.setdefault(cell, []).append(index)
+
+    # Returns all cells a box (x, y, width, height) overlaps
+    def box_cells(self, box):
+        x1, y1 = int(box[0] // self.cell_size), int(box[1] // self.cell_size)
+        x2, y2 = int((box[0] + box[2]) // self.cell_size), int((box[1] + box[3]) // self.cell_size)
+        return [(x, y) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+
+    # Returns indices of boxes sharing a cell with the given box
+    def query(self, box):
+        found = set()
+        for cell in self.box_cells(box):
+            found.update(self.cells.get(cell, ()))
+        return found
+
+
+# Matches a batch of detections to tracked boxes in one step
+class Associator:
+
+    def __init__(self, iou_threshold=0.3, cell_size=64):
+        self.iou_threshold = iou_threshold  # minimum overlap to consider a detection the same object
+        self.cell_size = cell_size
+
+    # Returns (matches as (detection, track) index pairs, unmatched detections, unmatched tracks).
+    # Boxes are x, y, width, height in the same pixel space
+    def match(self, detections, tracks):
+        if len(detections) == 0 or len(tracks) == 0:
+            return [], list(range(len(detections))), list(range(len(tracks)))
+
+        # Candidate pairs only between boxes in neighbouring cells
+        index = GridIndex(tracks, self.cell_size)
+        pairs = [(detection, track) for detection, box in enumerate(detections) for track in index.query(box)]
+
+        matches = []
+        if len(pairs) > 0:
+            pairs = np.array(pairs)
+            overlaps = iou(np.asarray(detections)[pairs[:, 0]], np.asarray(tracks)[pairs[:, 1]])
+
+            # Greedy assignment by highest IoU
+            used_detections, used_tracks = set(), set()
+            for pair in np.argsort(-overlaps, kind='stable'):
+                if overlaps[pair] < self.iou_threshold:
+                    break
+                detection, track = int(pairs[pair, 0]), int(pairs[pair, 1])
+                if detection in used_detections or track in used_tracks:
+                    continue
+                used_detections.add(detection)
+                used_tracks.add(track)
+                matches.append((detection, track))
+
+        matched_detections = {detection for detection, _ in matches}
+        matched_tracks = {track for _, track in matches}
+        return (matches,
+                [detection for detection in range(len(detections)) if detection not in matched_detections],
+                [track for track in range(len(tracks)) if track not in matched_tracks])
@@ -0,0 +1,285 @@
+"""
+This file contains the frame sources of the screen streamer: the live screen, the replay of a recording and raw
+B-scans rendered without the screen, and the recorder that writes captured frames to a memory-mappable file
+"""
+
+from mss import mss
+from utils.colormap import jet_lut, apply_colormap
+
+import numpy as np
+import cv2
+import logging
+import os
+import select
+import socket
+import struct
+import time
+
+# File layout: 64 byte header, then fixed size records of a float64 timestamp and the RGB frame
+MAGIC = b'RSODFRM1'
+HEADER = struct.Struct('<8sIIId')  # magic, height, width, channels, downscale factor (nan - none)
+HEADER_SIZE = 64
+TIMESTAMP = struct.Struct('<d')
+
+# B-scan message of the socket feed: header, then the samples in row-major order
+BSCAN_MAGIC = b'BSCN'
+BSCAN_HEADER = struct.Struct('<4sII8s')  # magic, rows, columns, numpy dtype string (e.g. b'<f4')
+
+
+# numpy record type of one frame, used for writing and for memory-mapping a recording
+def record_dtype(shape):
+    return np.dtype([('timestamp', '<f8'), ('image', np.uint8, tuple(shape))])
+
+
+# Screen grabs with mss, at most fps frames per second. capture(sct, monitor) returns (image, scale)
+class ScreenSource:
+
+    def __init__(self, capture, monitor, fps):
+        self.capture = capture
+        self.monitor = monitor
+        self.fps = fps
+
+    # Yields (image, scale, timestamp) forever, timestamp None means now
+    def frames(self):
+        sct = mss()  # mss must be used in the thread that created it
+        logging.info(f"MSS started with monitor : {self.monitor}")
+
+        next_capture = time.monotonic()
+        while True:
+            # Do not produce frames faster than fps, nobody would read them
+            delay = next_capture - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_capture = time.monotonic() + 1 / self.fps
+
+            image, scale = self.capture(sct, self.monitor)
+            yield image, scale, None
+
+
+# Frames of a recording, written into buffers of the frame ring. speed 1 replays at the recorded pace,
+# 2 twice as fast and so on, 0 as fast as the frame ring takes them
+class ReplaySource:
+
+    def __init__(self, path, frame_ring, speed=1.0, loop=False):
+        self.path = path
+        self.frame_ring = frame_ring
+        self.speed = speed
+        self.loop = loop
+
+        with open(path, 'rb') as file:
+            magic, height, width, channels, scale = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a frame recording")
+
+        self.scale = None if np.isnan(scale) else scale
+        dtype = record_dtype((height, width, channels))
+        count = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize  # a cut off last frame is ignored
+        if count == 0:
+            raise ValueError(f"{path} contains no frames")
+        self.records = np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+    # Yields (image, scale, timestamp) until the recording ends, timestamp None means now
+    def frames(self):
+        logging.info(f"Replaying {len(self.records)} frames from {self.path} at speed {self.speed}")
+
+        while True:
+            start = time.monotonic()
+            first = self.records[0]['timestamp']
+            for record in self.records:
+                if self.speed > 0:
+                    delay = start + (record['timestamp'] - first) / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                image = self.frame_ring.acquire(record['image'].shape)
+                np.copyto(image, record['image'])  # reads the frame from the mapped file
+                yield image, self.scale, None
+
+            if not self.loop:
+                return
+
+
+# Appends captured frames with their capture time to a recording. All frames must have the same shape
+class Recorder:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.dtype = None
+        self.count = 0
+
+    def write(self, image, scale, timestamp=None):
+        if self.file is None:
+            self.file = open(self.path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, *image.shape, float('nan') if scale is None else scale)
+                            .ljust(HEADER_SIZE, b'\0'))
+            self.dtype = record_dtype(image.shape)
+            logging.info(f"Recording frames of {image.shape} to {self.path}")
+        elif image.shape != self.dtype['image'].shape:
+            logging.warning(f"Frame size changed to {image.shape}, frame not recorded")
+            return
+
+        self.file.write(TIMESTAMP.pack(time.monotonic() if timestamp is None else timestamp))
+        self.file.write(np.ascontiguousarray(image).data)  # no copy for frames of the frame ring
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            logging.info(f"Recorded {self.count} frames to {self.path}")
+
+
+# Frame shape B-scans are rendered at: the screen area downscaled to DETECTION_SIZE high with the same
+# truncation as the screen capture, so the overlay maps boxes onto the screen area like for captured frames
+def bscan_shape(width, height, detection_size):
+    scale = height / detection_size
+    return int(height / scale), int(width / scale), 3
+
+
+# Renders raw B-scans (rows - time samples, columns - traces, like imagesc) into frames of the frame ring
+# with the jet colormap. value_range (min, max) fixes the colour scale, None - scaled to every B-scan
+class BScanRenderer:
+
+    def __init__(self, frame_ring, shape, scale, value_range=None):
+        self.frame_ring = frame_ring
+        self.shape = shape
+        self.scale = scale
+        self.value_range = value_range if value_range is not None else (None, None)
+        self.lut = jet_lut()
+        self.resized = np.empty(shape[:2], dtype=np.float32)
+
+    def render(self, bscan):
+        cv2.resize(np.asarray(bscan, dtype=np.float32), (self.shape[1], self.shape[0]), dst=self.resized,
+                   interpolation=cv2.INTER_AREA)
+        image = self.frame_ring.acquire(self.shape)
+        apply_colormap(self.resized, self.lut, *self.value_range, out=image)
+        return image
+
+
+# B-scans from a memory-mapped .npy file, at most fps frames per second. A 2D array is read again for every
+# frame, so a producer updating the file in place is followed live. A 3D array is a sequence of B-scans
+class BScanFileSource:
+
+    def __init__(self, path, renderer, fps, loop=False):
+        self.path = path
+        self.renderer = renderer
+        self.fps = fps
+        self.loop = loop
+
+        self.bscans = np.load(path, mmap_mode='r')
+        if self.bscans.ndim not in (2, 3):
+            raise ValueError(f"{path} is not a B-scan or a sequence of B-scans, shape {self.bscans.shape}")
+
+    # Yields (image, scale, timestamp) until the sequence ends, timestamp None means now
+    def frames(self):
+        logging.info(f"Rendering B-scans of {self.bscans.shape} from {self.path}")
+        sequence = self.bscans if self.bscans.ndim == 3 else None
+
+        next_frame = time.monotonic()
+        index = 0
+        while True:
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_frame = time.monotonic() + 1 / self.fps
+
+            if sequence is None:
+                bscan = self.bscans
+            else:
+                if index == len(sequence):
+                    if not self.loop:
+                        return
+                    index = 0
+                bscan = sequence[index]
+                index += 1
+
+            yield self.renderer.render(bscan), self.renderer.scale, None
+
+
+# Sends one B-scan to a BScanSocketSource, used by the producer
+def send_bscan(connection, bscan):
+    bscan = np.ascontiguousarray(bscan)
+    connection.sendall(BSCAN_HEADER.pack(BSCAN_MAGIC, *bscan.shape, bscan.dtype.str.encode()))
+    connection.sendall(bscan.data)
+
+
+# B-scans pushed by the radar software over a local TCP connection (see send_bscan), one producer at a time.
+# Only the newest B-scan is rendered, B-scans that arrived meanwhile are skipped.
+# running() is polled every timeout seconds while waiting, the source ends when it returns False
+class BScanSocketSource:
+
+    def __init__(self, address, renderer, running, timeout=1.0):
+        self.address = address
+        self.renderer = renderer
+        self.running = running
+        self.timeout = timeout
+        self.payloads = [bytearray(), bytearray()]  # B-scans are received into these in turn
+        self.next_payload = 0
+
+    # Yields (image, scale, timestamp) until running() returns False, timestamp None means now
+    def frames(self):
+        with socket.create_server(self.address) as server:
+            server.settimeout(self.timeout)
+            logging.info(f"Waiting for B-scans on {self.address[0]}:{self.address[1]}")
+
+            while self.running():
+                try:
+                    connection, peer = server.accept()
+                except socket.timeout:
+                    continue
+
+                logging.info(f"B-scan producer connected from {peer}")
+                with connection:
+                    connection.settimeout(self.timeout)
+                    try:
+                        bscan = self.receive(connection)
+                        while bscan is not None:
+                            # Skip to the newest B-scan if more are waiting. A read that ends at the disconnect
+                            # goes to the other buffer, the last complete B-scan is still rendered
+                            newer = bscan
+                            while newer is not None and select.select([connection], [], [], 0)[0]:
+                                newer = self.receive(connection)
+                                if newer is not None:
+                                    bscan = newer
+                            yield self.renderer.render(bscan), self.renderer.scale, None
+                            bscan = self.receive(connection) if newer is not None else None
+                    except (ValueError, OSError) as e:
+                        logging.warning(f"B-scan feed error: {e}")
+                logging.info("B-scan producer disconnected")
+
+    # Reads one B-scan, None if the producer disconnected or the source is stopped.
+    # The B-scan stays valid until the next B-scan was received, the one after overwrites it
+    def receive(self, connection):
+        header = bytearray(BSCAN_HEADER.size)
+        if not self.receive_into(connection, header):
+            return None
+        magic, rows, columns, dtype = BSCAN_HEADER.unpack(header)
+        if magic != BSCAN_MAGIC:
+            raise ValueError("lost synchronization with the producer")
+        dtype = np.dtype(dtype.rstrip(b'\0').decode())
+
+        size = rows * columns * dtype.itemsize
+        if len(self.payloads[self.next_payload]) < size:
+            self.payloads[self.next_payload] = bytearray(size)
+        payload = self.payloads[self.next_payload]
+        if not self.receive_into(connection, memoryview(payload)[:size]):
+            return None
+
+        self.next_payload = 1 - self.next_payload
+        return np.frombuffer(payload, dtype=dtype, count=rows * columns).reshape(rows, columns)
+
+    def receive_into(self, connection, buffer):
+        view = memoryview(buffer)
+        received = 0
+        while received < len(view):
+            try:
+                count = connection.recv_into(view[received:])
+            except socket.timeout:
+                if not self.running():
+                    return False
+                continue
+            if count == 0:
+                return False
+            received += count
+        return True
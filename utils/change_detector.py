@@ -0,0 +1,33 @@
+"""
+This file contains a cheap check whether a captured frame changed since the last inference
+"""
+
+import numpy as np
+import cv2
+
+
+# Compares block averages of a frame with the last frame that went through inference
+class ChangeDetector:
+
+    def __init__(self, threshold=4, grid=(64, 36)):
+        self.threshold = threshold  # block average difference (0-255) counted as a change, 0 - always changed
+        self.grid = grid  # number of blocks (columns, rows)
+        self.reference = None  # block averages of the last inferred frame
+        self.skipped = 0  # frames reported unchanged
+
+    # Returns True if any block differs from the last inferred frame by more than threshold.
+    # A changed frame becomes the new reference, since it is going to be inferred
+    def changed(self, image):
+        if self.threshold <= 0:
+            return True
+
+        # INTER_AREA averages every block of pixels into one thumbnail pixel
+        blocks = cv2.resize(image, self.grid, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+        if (self.reference is None or self.reference.shape != blocks.shape
+                or np.abs(blocks - self.reference).max() > self.threshold):
+            self.reference = blocks
+            return True
+
+        self.skipped += 1
+        return False
@@ -0,0 +1,27 @@
+"""
+This file contains a vectorized jet colormap that renders radargrams the way MATLAB imagesc does
+"""
+
+import numpy as np
+
+
+# MATLAB-like jet colormap as an (n, 3) uint8 RGB lookup table
+def jet_lut(n=256):
+    x = np.linspace(0, 1, n)
+    channels = [np.clip(1.5 - np.abs(4 * x - offset), 0, 1) for offset in (3, 2, 1)]  # red, green, blue
+    return np.round(255 * np.stack(channels, axis=1)).astype(np.uint8)
+
+
+# Maps data to RGB through a lookup table. Values are scaled from vmin..vmax (by default the data minimum
+# and maximum, like imagesc) to the table. out is an optional (height, width, 3) uint8 buffer
+def apply_colormap(data, lut, vmin=None, vmax=None, out=None):
+    vmin = float(data.min()) if vmin is None else vmin
+    vmax = float(data.max()) if vmax is None else vmax
+    scale = (len(lut) - 1) / (vmax - vmin) if vmax > vmin else 0.0
+
+    # float32 scratch and uint8 indices keep this a few passes over small arrays
+    indices = np.subtract(data, vmin, dtype=np.float32)
+    indices *= scale
+    indices += 0.5
+    np.clip(indices, 0, len(lut) - 1, out=indices)
+    return np.take(lut, indices.astype(np.uint8 if len(lut) <= 256 else np.intp), axis=0, out=out)
@@ -0,0 +1,96 @@
+"""
+This file contains a scheduler that decides when the next detection should run
+"""
+
+from threading import Event
+
+import time
+import logging
+
+
+# Triggers detection on new frames with a target rate, backs off when inference is slow
+# and can be woken up early, for example when a tracker loses its object
+class DetectionScheduler:
+
+    def __init__(self, frame_ring, target_rate=5, backoff=1.5, report_interval=10, metrics=None):
+        self.frame_ring = frame_ring
+        self.metrics = metrics  # MetricsRegistry, records the inference latency histogram
+        self.target_rate = target_rate  # detections per second, 0 means as fast as possible
+        self.backoff = backoff  # minimum interval as a multiple of the inference time
+        self.report_interval = report_interval  # seconds between rate reports
+
+        self.sequence = 0  # last frame a detection ran on
+        self.inference_time = None  # exponential moving average in seconds
+        self.last_start = 0
+        self.triggered = Event()
+
+        self.count = 0
+        self.skipped = 0  # detections answered from cache because the screen did not change
+        self.window_start = time.monotonic()
+        self.rate = 0.0  # achieved detections per second over the last report window
+
+    # Minimum time between two detections
+    def interval(self):
+        interval = 1 / self.target_rate if self.target_rate > 0 else 0
+        return max(interval, self.backoff_interval())
+
+    # Minimum time between two detections when inference is slow, leaves the CPU some room for capture and tracking
+    def backoff_interval(self):
+        return self.inference_time * self.backoff if self.inference_time is not None else 0
+
+    # Requests a detection as soon as a new frame is available, skipping the target rate but not the backoff
+    def trigger(self):
+        self.triggered.set()
+
+    # Blocks until a detection should run. Returns False if no new frame arrived within timeout
+    def wait(self, timeout=None):
+        remaining = self.last_start + self.interval() - time.monotonic()
+        if remaining > 0:
+            self.triggered.wait(remaining)  # returns early when triggered
+        self.triggered.clear()
+
+        # Repeated triggers must not run a slow model back-to-back
+        remaining = self.last_start + self.backoff_interval() - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        with self.frame_ring.read_newer(self.sequence, timeout) as frame:
+            if frame is None:
+                return False
+            self.sequence = frame.sequence
+        return True
+
+    # Marks the start of a detection and returns its start time
+    def start(self):
+        self.last_start = time.monotonic()
+        return self.last_start
+
+    # Records the duration of a detection started at start_time and the sequence number of the frame it read,
+    # which may be newer than the one wait saw. Skipped detections did not run the model and do not count
+    # towards the inference time
+    def finish(self, start_time, skipped=False, sequence=None):
+        now = time.monotonic()
+        duration = now - start_time
+        if sequence is not None:
+            self.sequence = max(self.sequence, sequence)
+        if skipped:
+            self.skipped += 1
+        elif self.inference_time is None:
+            self.inference_time = duration
+        else:
+            self.inference_time = 0.8 * self.inference_time + 0.2 * duration
+
+        if self.metrics is not None:
+            self.metrics.rate('detections').mark()
+            if not skipped:
+                self.metrics.histogram('inference_ms').observe(1000 * duration)
+
+        self.count += 1
+        elapsed = now - self.window_start
+        if elapsed >= self.report_interval:
+            self.rate = self.count / elapsed
+            self.count = 0
+            self.window_start = now
+            inference_ms = 1000 * self.inference_time if self.inference_time is not None else 0
+            logging.info(f"Detection rate : {self.rate:.2f}/s, average inference : {inference_ms:.0f} ms, "
+                         f"skipped unchanged frames : {self.skipped}")
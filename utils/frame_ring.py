@@ -0,0 +1,254 @@
+"""
+This file contains a small ring of reusable frame buffers shared between capture and consumer threads,
+and a variant in shared memory for capture and consumers running in separate processes
+"""
+
+from contextlib import contextmanager
+from multiprocessing import get_context, shared_memory
+from threading import Condition
+
+import numpy as np
+import logging
+import time
+
+STALL_WARNING = 5  # seconds the producer of a SharedFrameRing waits for a free slot before it warns
+
+
+# A published frame with its sequence number, capture time and downscale factor
+class Frame:
+    __slots__ = ('image', 'sequence', 'timestamp', 'scale', 'slot')
+
+    def __init__(self, image, sequence, timestamp, scale, slot):
+        self.image = image
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.scale = scale
+        self.slot = slot
+
+    # Returns how many seconds ago the frame was captured
+    def age(self):
+        return time.monotonic() - self.timestamp
+
+
+# Holds a few preallocated frame buffers. The producer writes into a buffer nobody reads,
+# consumers pin the frame they are working on so it is never overwritten under them
+class FrameRing:
+
+    def __init__(self, size=3):
+        self.size = max(2, size)
+        self.buffers = []  # preallocated images, one per slot
+        self.readers = []  # number of consumers currently pinning each slot
+        self.latest_frame = None
+        self.sequence = 0
+        self.writing = None  # slot handed out to the producer
+        self.condition = Condition()
+
+    # Allocates buffers when the frame size changes
+    def _ensure_buffers(self, shape, dtype):
+        if len(self.buffers) > 0 and self.buffers[0].shape == shape and self.buffers[0].dtype == dtype:
+            return
+
+        self.buffers = [np.empty(shape, dtype=dtype) for _ in range(self.size)]
+        self.readers = [0] * self.size
+        self.latest_frame = None
+
+    # Returns a writable buffer that is neither the latest frame nor pinned by a consumer
+    def acquire(self, shape, dtype=np.uint8):
+        with self.condition:
+            self._ensure_buffers(tuple(shape), np.dtype(dtype))
+            latest = self.latest_frame.slot if self.latest_frame is not None else None
+
+            # Oldest free slot first, so consumers get the longest window on older frames
+            for offset in range(1, self.size + 1):
+                slot = ((latest if latest is not None else -1) + offset) % self.size
+                if slot != latest and self.readers[slot] == 0:
+                    self.writing = slot
+                    return self.buffers[slot]
+
+            # Every slot is pinned, grow the ring instead of tearing a frame
+            self.buffers.append(np.empty_like(self.buffers[0]))
+            self.readers.append(0)
+            self.size += 1
+            self.writing = self.size - 1
+            return self.buffers[self.writing]
+
+    # Publishes the buffer returned by acquire and wakes up waiting consumers
+    def publish(self, buffer, scale=None, timestamp=None):
+        with self.condition:
+            if self.writing is None or self.buffers[self.writing] is not buffer:
+                raise ValueError("Only a buffer returned by acquire can be published")
+
+            self.sequence += 1
+            self.latest_frame = Frame(buffer, self.sequence,
+                                      time.monotonic() if timestamp is None else timestamp, scale, self.writing)
+            self.writing = None
+            self.condition.notify_all()
+            return self.sequence
+
+    # Pins and returns the latest frame, or None if nothing was published yet
+    def latest(self):
+        with self.condition:
+            return self._pin(self.latest_frame)
+
+    # Blocks until a frame newer than sequence is published, pins and returns it. Returns None on timeout
+    def wait_newer(self, sequence, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: self.latest_frame is not None and self.latest_frame.sequence > sequence, timeout):
+                return None
+            return self._pin(self.latest_frame)
+
+    # Unpins a frame returned by latest or wait_newer
+    def release(self, frame):
+        if frame is None:
+            return
+        with self.condition:
+            if frame.slot < len(self.readers) and self.buffers[frame.slot] is frame.image:
+                self.readers[frame.slot] -= 1
+
+    def _pin(self, frame):
+        if frame is not None:
+            self.readers[frame.slot] += 1
+        return frame
+
+    # Context manager around latest/release
+    @contextmanager
+    def read_latest(self):
+        frame = self.latest()
+        try:
+            yield frame
+        finally:
+            self.release(frame)
+
+    # Context manager around wait_newer/release
+    @contextmanager
+    def read_newer(self, sequence, timeout=None):
+        frame = self.wait_newer(sequence, timeout)
+        try:
+            yield frame
+        finally:
+            self.release(frame)
+
+
+# FrameRing with frames of one fixed shape in shared memory, for capture, inference and tracking in separate
+# processes. Slot bookkeeping lives in shared arrays guarded by a process-shared condition. The ring is
+# passed to child processes as a process argument, they attach to the same memory by name.
+# Shared memory cannot grow. With size at least the number of consumers + 2 and every consumer pinning one frame
+# at a time, a slot is always free. Otherwise the producer waits for a consumer to release one, frames are never
+# overwritten while pinned
+class SharedFrameRing(FrameRing):
+
+    def __init__(self, shape, size=4, dtype=np.uint8, context=None):
+        context = context or get_context('spawn')
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.size = max(3, size)
+        self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        self.memory = shared_memory.SharedMemory(create=True, size=self.frame_bytes * self.size)
+        self.owner = True  # the creating process unlinks the memory on close
+
+        self.sequences = context.RawArray('q', self.size)  # sequence number of the frame in each slot
+        self.timestamps = context.RawArray('d', self.size)
+        self.scales = context.RawArray('d', self.size)  # nan for frames published without a scale
+        self.readers = context.RawArray('i', self.size)  # consumers pinning each slot, in any process
+        self.control = context.RawArray('q', 3)  # latest slot, slot handed out to the producer, last sequence
+        self.control[0] = self.control[1] = -1
+        self.condition = context.Condition()
+
+        self._attach()
+
+    # Creates the numpy views of the slots
+    def _attach(self):
+        self.buffers = [np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf,
+                                   offset=slot * self.frame_bytes) for slot in range(self.size)]
+
+    # Child processes get everything but the memory mapping and attach by name
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory'] = self.memory.name
+        state['owner'] = False
+        del state['buffers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memory = shared_memory.SharedMemory(name=state['memory'])
+        self._attach()
+
+    @property
+    def sequence(self):
+        return self.control[2]
+
+    # Returns a writable buffer that is neither the latest frame nor pinned by a consumer
+    def acquire(self, shape, dtype=np.uint8):
+        if tuple(shape) != self.shape or np.dtype(dtype) != self.dtype:
+            raise ValueError(f"Shared frames are {self.shape} {self.dtype}, got {tuple(shape)} {np.dtype(dtype)}")
+
+        with self.condition:
+            while True:
+                latest = self.control[0]
+                free = [slot for slot in range(self.size) if slot != latest and self.readers[slot] == 0]
+                if free:
+                    break
+                # More consumers than the ring was sized for, or one hangs with its pin
+                if not self.condition.wait(STALL_WARNING):
+                    logging.warning(f"All {self.size} shared frames are pinned, waiting for a consumer")
+
+            # Oldest free slot first, so consumers get the longest window on older frames
+            slot = min(free, key=lambda slot: self.sequences[slot])
+            self.control[1] = slot
+            return self.buffers[slot]
+
+    # Publishes the buffer returned by acquire and wakes up waiting consumers in all processes
+    def publish(self, buffer, scale=None, timestamp=None):
+        with self.condition:
+            slot = self.control[1]
+            if slot < 0 or self.buffers[slot] is not buffer:
+                raise ValueError("Only a buffer returned by acquire can be published")
+
+            self.control[2] += 1
+            self.sequences[slot] = self.control[2]
+            self.timestamps[slot] = time.monotonic() if timestamp is None else timestamp
+            self.scales[slot] = float('nan') if scale is None else scale
+            self.control[0] = slot
+            self.control[1] = -1
+            self.condition.notify_all()
+            return self.control[2]
+
+    # Pins and returns the latest frame, or None if nothing was published yet
+    def latest(self):
+        with self.condition:
+            return self._pin(self.control[0])
+
+    # Blocks until a frame newer than sequence is published, pins and returns it. Returns None on timeout
+    def wait_newer(self, sequence, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(
+                    lambda: self.control[0] >= 0 and self.sequences[self.control[0]] > sequence, timeout):
+                return None
+            return self._pin(self.control[0])
+
+    # Unpins a frame returned by latest or wait_newer, wakes up a producer waiting for a free slot
+    def release(self, frame):
+        if frame is None:
+            return
+        with self.condition:
+            if self.readers[frame.slot] > 0:
+                self.readers[frame.slot] -= 1
+                self.condition.notify_all()
+
+    def _pin(self, slot):
+        if slot < 0:
+            return None
+        self.readers[slot] += 1
+        scale = self.scales[slot]
+        return Frame(self.buffers[slot], self.sequences[slot], self.timestamps[slot],
+                     None if np.isnan(scale) else scale, slot)
+
+    # Detaches from the shared memory, the owner also frees it
+    def close(self):
+        self.buffers = []
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
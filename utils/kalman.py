@@ -0,0 +1,79 @@
+"""
+This file realizes a constant-velocity Kalman filter that steps all tracked objects at once
+"""
+
+import numpy as np
+
+
+# Kalman filter for many objects with state (x, y, vx, vy) and measurement (x, y).
+# Same model and update order as the per-object cv2.KalmanFilter(4, 2, 0) in Tracking,
+# but states and covariances of all objects live in contiguous (N, 4) / (N, 4, 4) arrays
+class BatchKalman:
+
+    transition = np.array([[1, 0, 1, 0],
+                           [0, 1, 0, 1],
+                           [0, 0, 1, 0],
+                           [0, 0, 0, 1]], np.float32)
+
+    def __init__(self, capacity=64, process_noise=0.03, measurement_noise=1.0):
+        self.process_noise = np.eye(4, dtype=np.float32) * process_noise
+        self.measurement_noise = np.eye(2, dtype=np.float32) * measurement_noise
+
+        self.state = np.zeros((capacity, 4), np.float32)  # predicted state of every slot
+        self.covariance = np.zeros((capacity, 4, 4), np.float32)  # predicted error covariance
+        self.active = np.zeros(capacity, bool)
+        self.free = list(range(capacity - 1, -1, -1))  # unused slots, popped from the end
+
+    # Doubles the capacity, only happens when all slots are in use
+    def _grow(self):
+        capacity = len(self.state)
+        self.state = np.concatenate([self.state, np.zeros_like(self.state)])
+        self.covariance = np.concatenate([self.covariance, np.zeros_like(self.covariance)])
+        self.active = np.concatenate([self.active, np.zeros(capacity, bool)])
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    # Reserves a slot for a new object and returns its index
+    def add(self, x=0, y=0):
+        if len(self.free) == 0:
+            self._grow()
+        index = self.free.pop()
+        self.reset(index, x, y)
+        self.active[index] = True
+        return index
+
+    # Starts an object at (x, y) with no velocity and no uncertainty
+    def reset(self, index, x, y):
+        self.state[index] = (x, y, 0, 0)
+        self.covariance[index] = 0
+
+    # Releases the slot of a removed object
+    def remove(self, index):
+        if self.active[index]:
+            self.active[index] = False
+            self.free.append(index)
+
+    # Corrects the given objects with measured positions (M, 2), predicts their next state
+    # and returns the predicted positions (M, 2)
+    def step(self, indices, measurements):
+        indices = np.asarray(indices, dtype=int)
+        measurements = np.asarray(measurements, dtype=np.float32).reshape(-1, 2)
+        state = self.state[indices]
+        covariance = self.covariance[indices]
+
+        # Correct: the measurement matrix picks x and y, so H P H^T is the top-left 2x2 block
+        innovation_cov = covariance[:, :2, :2] + self.measurement_noise
+        a, b = innovation_cov[:, 0, 0], innovation_cov[:, 0, 1]
+        c, d = innovation_cov[:, 1, 0], innovation_cov[:, 1, 1]
+        inverse = np.stack([np.stack([d, -b], -1), np.stack([-c, a], -1)], -2) / (a * d - b * c)[:, None, None]
+        gain = covariance[:, :, :2] @ inverse  # (M, 4, 2)
+
+        state = state + (gain @ (measurements - state[:, :2])[:, :, None])[:, :, 0]
+        covariance = covariance - gain @ covariance[:, :2, :]
+
+        # Predict
+        state = state @ self.transition.T
+        covariance = self.transition @ covariance @ self.transition.T + self.process_noise
+
+        self.state[indices] = state
+        self.covariance[indices] = covariance
+        return state[:, :2]
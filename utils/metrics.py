@@ -0,0 +1,193 @@
+"""
+This file contains a metrics registry that times and counts the stages of the pipeline,
+reports them periodically to pluggable sinks and summarizes them for the overlay
+"""
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+import json
+import time
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket takes everything above
+DEFAULT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+# Counts events and reports how many happened per second over the last window seconds
+class Rate:
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self.events = deque()
+        self.total = 0
+        self.lock = Lock()  # marked from worker pools, for example tracker_inits
+
+    def mark(self):
+        now = time.monotonic()
+        with self.lock:
+            self.events.append(now)
+            self.total += 1
+            while self.events[0] < now - self.window:
+                self.events.popleft()
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            recent = sum(1 for event in self.events if event >= now - self.window)
+            total = self.total
+        return {'per_second': recent / self.window, 'total': total}
+
+    def summary(self):
+        return f"{self.snapshot()['per_second']:.1f}/s"
+
+
+# Last value of something, for example the number of active tracks
+class Gauge:
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return {'value': self.value}
+
+    def summary(self):
+        return str(self.value)
+
+
+# Distribution of durations in milliseconds over fixed buckets, percentiles are bucket upper bounds
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += value
+            self.last = value
+            if value > self.max:
+                self.max = value
+
+    # Upper bound of the bucket that holds the given fraction of all values
+    def percentile(self, fraction):
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        labels = [str(bound) for bound in self.buckets] + ['inf']
+        with self.lock:
+            return {'count': self.count, 'mean': self.sum / self.count if self.count else 0.0, 'max': self.max,
+                    'last': self.last, 'p50': self.percentile(0.5), 'p95': self.percentile(0.95),
+                    'buckets': dict(zip(labels, self.counts))}
+
+    def summary(self):
+        with self.lock:
+            mean = self.sum / self.count if self.count else 0.0
+            return f"{mean:.1f} ms (p95 {self.percentile(0.95)})"
+
+
+# Appends one JSON line per report to a file
+class FileSink:
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, name, snapshot):
+        with open(self.path, 'a') as file:
+            file.write(json.dumps({'time': time.time(), 'process': name, 'metrics': snapshot}) + '\n')
+
+
+# Named metrics of one process. Metrics are created on first use, rates and histograms may be updated from
+# several threads, gauges keep whichever value was set last.
+# Sinks are callables taking (registry name, snapshot), they are called from the reporting thread
+class MetricsRegistry:
+
+    def __init__(self, name='main'):
+        self.name = name
+        self.metrics = {}
+        self.sinks = []
+        self.remote = {}  # snapshots reported by other processes, shown in the overlay summary
+        self.lock = Lock()
+        self.reporting = False
+
+    def _get(self, name, kind):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(name, kind())
+        return metric
+
+    def rate(self, name):
+        return self._get(name, Rate)
+
+    def gauge(self, name):
+        return self._get(name, Gauge)
+
+    def histogram(self, name):
+        return self._get(name, Histogram)
+
+    # Records the duration of the enclosed block in the histogram name
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe(1000 * (time.perf_counter() - start))
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    # Lines for the overlay, one per metric, including metrics of other processes
+    def summary(self):
+        lines = [f"{name}: {metric.summary()}" for name, metric in sorted(list(self.metrics.items()))]
+        for process, snapshot in sorted(list(self.remote.items())):
+            for name, values in sorted(snapshot.items()):
+                if 'per_second' in values:
+                    lines.append(f"{process} {name}: {values['per_second']:.1f}/s")
+                elif 'mean' in values:
+                    lines.append(f"{process} {name}: {values['mean']:.1f} ms (p95 {values['p95']})")
+                else:
+                    lines.append(f"{process} {name}: {values['value']}")
+        return lines
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    # Sends a snapshot, and the latest snapshots of other processes, to every sink
+    def report(self):
+        snapshots = [(self.name, self.snapshot())] + list(self.remote.items())
+        for sink in self.sinks:
+            for name, snapshot in snapshots:
+                sink(name, snapshot)
+
+    # Reports every interval seconds in a background thread
+    def start_reporting(self, interval):
+        if self.reporting or len(self.sinks) == 0:
+            return
+        self.reporting = True
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.report()
+
+        Thread(target=loop, name=f"metrics-{self.name}", daemon=True).start()
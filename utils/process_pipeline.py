@@ -0,0 +1,305 @@
+"""
+This file contains an optional pipeline that runs capture, inference and tracking in separate processes.
+Frames are passed through shared memory, detections and tracked boxes come back to the GUI over small queues
+"""
+
+from multiprocessing import get_context
+from queue import Empty, Full
+from threading import Thread
+
+from utils.frame_ring import SharedFrameRing
+from utils.capture_source import bscan_shape
+from utils.metrics import MetricsRegistry
+from utils import queued_logging
+from utils.detection_scheduler import DetectionScheduler
+from utils.shared_variables import ScreenStreamer
+from utils.tracking import Tracking, MultiTracking
+
+import logging
+import time
+
+POLL_TIMEOUT = 0.1  # seconds a process waits on a queue before it checks for shutdown
+JOIN_TIMEOUT = 5  # seconds a process gets to stop before it is terminated
+FRAME_READERS = 2  # processes pinning shared frames, inference and tracking, each pins one frame at a time
+
+
+# Settings and state of one pipeline process, built from the picklable settings of SharedVariables
+class ProcessVariables:
+    detection_ready = True
+    detection_scheduler = None
+    DETECTION_SCALE = 0
+
+    def __init__(self, settings, frame_ring, stop_event, metrics_queue, name):
+        self.__dict__.update(settings)
+        self.frame_ring = frame_ring
+        self.stop_event = stop_event
+
+        # Metrics go to the GUI, which shows them in the overlay and writes the metrics file
+        self.metrics = MetricsRegistry(name)
+        if self.METRICS_FILE is not None or self.SHOW_METRICS:
+            self.metrics.add_sink(lambda process, snapshot: put_latest(metrics_queue, (process, snapshot)))
+            self.metrics.start_reporting(1 if self.SHOW_METRICS else self.METRICS_INTERVAL)
+
+    # All loops of a process end when the GUI stops the pipeline
+    @property
+    def stream_running(self):
+        return not self.stop_event.is_set()
+
+
+# Stands in for the detection scheduler in the tracking process, wakes up the scheduler of the inference process
+class DetectionTrigger:
+
+    def __init__(self, event):
+        self.event = event
+
+    def trigger(self):
+        self.event.set()
+
+
+# Progress callback of MultiTracking in the tracking process. Sends the boxes of the active trackings and
+# the keys of the lost ones. An update the GUI has no room for is dropped, its lost keys go with the next one
+class TrackPublisher:
+
+    def __init__(self, tracks):
+        self.tracks = tracks
+        self.active = set()
+        self.lost = set()
+
+    def emit(self, trackings):
+        boxes = {tracking.key: tuple(tracking.box) for tracking in trackings}
+        self.lost |= self.active - boxes.keys()
+        self.active = set(boxes)
+
+        try:
+            self.tracks.put_nowait((boxes, list(self.lost)))
+            self.lost = set()
+        except Full:
+            pass
+
+
+# Puts item on a bounded queue, drops the oldest item when the consumer falls behind
+def put_latest(queue, item):
+    while True:
+        try:
+            queue.put_nowait(item)
+            return
+        except Full:
+            try:
+                queue.get_nowait()
+            except Empty:
+                pass
+
+
+# Returns everything waiting on a queue without blocking
+def drain(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except Empty:
+            return items
+
+
+# Child processes do not inherit the logging setup of the GUI, they log to the console through a queue
+def configure_process_logging(level):
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(levelname)s - %(processName)s - %(message)s'))
+    queued_logging.start([console_handler], level)
+
+
+# Capture process, publishes screen frames into the shared frame ring
+def capture_process(settings, frame_ring, stop_event, metrics_queue):
+    configure_process_logging(settings['LOG_LEVEL'])
+    ScreenStreamer(shared_variables=ProcessVariables(settings, frame_ring, stop_event, metrics_queue,
+                                                     'capture')).run()
+    frame_ring.close()
+
+
+# Inference process, loads the model and sends detections of new frames to the GUI
+def inference_process(settings, frame_ring, stop_event, metrics_queue, trigger_event, detections):
+    configure_process_logging(settings['LOG_LEVEL'])
+    shared_variables = ProcessVariables(settings, frame_ring, stop_event, metrics_queue, 'inference')
+
+    detection_model = shared_variables.model(shared_variables=shared_variables)
+    detection_model.download_model()
+    detection_model.load_model()
+    if shared_variables.TILED_DETECTION:
+        detection_model.warm_up((shared_variables.TILE_SIZE, shared_variables.TILE_SIZE, 3))
+    else:
+        detection_model.warm_up(frame_ring.shape)
+    logging.info("Model loaded")
+
+    scheduler = DetectionScheduler(frame_ring, settings['DETECTION_RATE'], settings['DETECTION_BACKOFF'],
+                                   metrics=shared_variables.metrics)
+    scheduler.triggered = trigger_event  # set by the tracking process
+
+    while shared_variables.stream_running:
+        if len(shared_variables.SHOW_ONLY) == 0:
+            time.sleep(shared_variables.DETECTION_DURATION)
+        elif scheduler.wait(shared_variables.DETECTION_DURATION):
+            start_time = scheduler.start()
+            boxes = detection_model.predict()
+            scheduler.finish(start_time, detection_model.unchanged, detection_model.last_sequence)
+            if boxes is not None:  # None - no new frame or unchanged screen, nothing to associate
+                put_latest(detections, boxes)  # only the newest detections are worth associating
+
+    frame_ring.close()
+
+
+# Applies add/refresh/remove commands of the GUI to the tracking engine
+def apply_commands(engine, shared_variables, commands):
+    trackings = {}  # key -> Tracking
+    while shared_variables.stream_running:
+        try:
+            command, key, box = commands.get(timeout=POLL_TIMEOUT)
+        except Empty:
+            continue
+
+        if command == 'add':
+            tracking = Tracking(box, shared_variables)
+            tracking.key = key
+            trackings = {key: tracking for key, tracking in trackings.items() if tracking.running}
+            trackings[key] = tracking
+            engine.add_tracker(tracking)
+        elif key in trackings and command == 'refresh':
+            engine.refresh_tracker(trackings[key], box)
+        elif key in trackings and command == 'remove':
+            engine.remove_tracker(trackings.pop(key))
+
+
+# Tracking process, updates all trackers on every new frame and sends the boxes to the GUI
+def tracking_process(settings, frame_ring, stop_event, metrics_queue, trigger_event, commands, tracks):
+    configure_process_logging(settings['LOG_LEVEL'])
+    shared_variables = ProcessVariables(settings, frame_ring, stop_event, metrics_queue, 'tracking')
+    shared_variables.detection_scheduler = DetectionTrigger(trigger_event)
+
+    engine = MultiTracking(shared_variables, settings['TRACKING_WORKERS'])
+    Thread(target=apply_commands, args=(engine, shared_variables, commands), daemon=True).start()
+    engine.run(TrackPublisher(tracks))
+
+    frame_ring.close()
+
+
+# GUI side of the pipeline. Starts and stops the processes and has the add/refresh/remove interface
+# of MultiTracking, so the GUI associates detections the same way as with the threaded pipeline.
+# The Tracking objects of the GUI mirror the trackers of the tracking process
+class ProcessPipeline:
+
+    def __init__(self, shared_variables, detection_rate=5, detection_backoff=1.5, tracking_workers=0,
+                 queue_size=2):
+        self.shared_variables = shared_variables
+        context = get_context('spawn')  # forking a process with running Qt and capture threads is unsafe
+
+        # The frame size is fixed up front, shared memory cannot be reallocated on the fly
+        if shared_variables.BSCAN_SOURCE is not None:
+            scale = shared_variables.HEIGHT / shared_variables.DETECTION_SIZE
+            shape = bscan_shape(shared_variables.WIDTH, shared_variables.HEIGHT, shared_variables.DETECTION_SIZE)
+        else:
+            if shared_variables.TILED_DETECTION or shared_variables.HEIGHT <= shared_variables.DETECTION_SIZE:
+                scale = 1.0
+            else:
+                scale = shared_variables.HEIGHT / shared_variables.DETECTION_SIZE
+            shape = (int(shared_variables.HEIGHT / scale), int(shared_variables.WIDTH / scale), 3)
+        shared_variables.DETECTION_SCALE = scale
+
+        # Two more slots than readers, the latest frame and the one being captured, so capture never waits
+        self.frame_ring = SharedFrameRing(shape, max(shared_variables.CAPTURE_BUFFERS + 1, FRAME_READERS + 2),
+                                          context=context)
+        shared_variables.frame_ring = self.frame_ring
+
+        self.stop_event = context.Event()
+        self.trigger_event = context.Event()
+        self.detections = context.Queue(queue_size)  # bounded, inference drops old detections
+        self.tracks = context.Queue(queue_size)  # bounded, tracking drops updates the GUI has no time for
+        self.commands = context.Queue()  # commands are never dropped
+        self.metrics_queue = context.Queue(8)  # latest metrics snapshot of each process
+
+        settings = {name: getattr(shared_variables, name) for name in dir(shared_variables) if name.isupper()}
+        settings.update(model=shared_variables.model, DETECTION_RATE=detection_rate,
+                        DETECTION_BACKOFF=detection_backoff, TRACKING_WORKERS=tracking_workers,
+                        LOG_LEVEL=logging.getLogger().getEffectiveLevel())
+
+        self.processes = [
+            context.Process(target=capture_process, name='capture', daemon=True,
+                            args=(settings, self.frame_ring, self.stop_event, self.metrics_queue)),
+            context.Process(target=inference_process, name='inference', daemon=True,
+                            args=(settings, self.frame_ring, self.stop_event, self.metrics_queue, self.trigger_event,
+                                  self.detections)),
+            context.Process(target=tracking_process, name='tracking', daemon=True,
+                            args=(settings, self.frame_ring, self.stop_event, self.metrics_queue, self.trigger_event,
+                                  self.commands, self.tracks)),
+        ]
+
+        self.trackings = {}  # key -> Tracking mirrored in the GUI
+        self.next_key = 0
+        self.stopped = False
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logging.info(f"Pipeline processes started: {', '.join(process.name for process in self.processes)}")
+
+    # Starts tracking a box in the tracking process
+    def add_tracker(self, tracking):
+        tracking.key = self.next_key
+        self.next_key += 1
+        self.trackings[tracking.key] = tracking
+        self.commands.put(('add', tracking.key, tuple(tracking.box)))
+
+    # Restarts a tracking on a new detection box
+    def refresh_tracker(self, tracking, box):
+        self.commands.put(('refresh', tracking.key, tuple(box)))
+
+    # Stops tracking an object
+    def remove_tracker(self, tracking):
+        tracking.running = False
+        self.trackings.pop(tracking.key, None)
+        self.commands.put(('remove', tracking.key, None))
+
+    # Called from the GUI thread. Applies tracked boxes to the mirrored trackings and returns
+    # the detections that arrived since the last call and whether any box moved
+    def poll(self):
+        detections = drain(self.detections)
+        updates = drain(self.tracks)
+        for process, snapshot in drain(self.metrics_queue):
+            self.shared_variables.metrics.remote[process] = snapshot
+
+        for boxes, lost in updates:
+            for key, box in boxes.items():
+                tracking = self.trackings.get(key)
+                if tracking is not None:
+                    tracking.box = box
+            for key in lost:
+                tracking = self.trackings.pop(key, None)
+                if tracking is not None:
+                    tracking.running = False
+
+        # A crashed process takes the pipeline down instead of leaving a frozen overlay
+        for process in self.processes:
+            if process.exitcode is not None and not self.stopped:
+                logging.error(f"Pipeline process {process.name} exited with code {process.exitcode}")
+                self.stop()
+
+        return detections, len(updates) > 0
+
+    # Stops all processes and frees the shared memory, safe to call more than once
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.stop_event.set()
+
+        for process in self.processes:
+            if process.pid is None:
+                continue
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                logging.warning(f"Pipeline process {process.name} did not stop, terminating it")
+                process.terminate()
+                process.join()
+
+        for queue in (self.detections, self.tracks, self.commands, self.metrics_queue):
+            queue.cancel_join_thread()
+            queue.close()
+        self.frame_ring.close()
+        logging.info("Pipeline processes stopped")
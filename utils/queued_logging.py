@@ -0,0 +1,83 @@
+"""
+This file contains a non-blocking logging setup for the real-time loops. Records go through a bounded queue
+to a background thread that formats and writes them, repeated debug messages are rate-limited per call site
+"""
+
+from logging.handlers import QueueHandler, QueueListener
+
+import atexit
+import logging
+import queue
+
+
+# Lets at most burst records of one call site through every interval seconds. The first record of the
+# next window tells how many were suppressed. Records above max_level are never limited.
+# Counting is approximate when several threads log from the same line, which is fine for sampling
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, burst=5, interval=1.0, max_level=logging.DEBUG):
+        super(RateLimitFilter, self).__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_level = max_level
+        self.sites = {}  # (pathname, lineno) -> [window start, passed, suppressed]
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+
+        key = (record.pathname, record.lineno)
+        site = self.sites.get(key)
+        if site is None or record.created - site[0] >= self.interval:
+            if site is not None and site[2] > 0:
+                record.msg = f"{record.msg} (suppressed {site[2]} similar)"
+            site = self.sites[key] = [record.created, 0, 0]
+
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+
+# QueueHandler that never blocks the logging thread. When the queue is full the record is dropped,
+# a warning with the number of dropped records is queued as soon as there is room again
+class DroppingQueueHandler(QueueHandler):
+    dropped = 0
+
+    # Only merges the message with its arguments, so later changes of the arguments do not show up.
+    # Formatting with time, level and so on happens in the listener thread
+    def prepare(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped > 0:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': 'logging', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f"Log queue full, dropped {self.dropped} records"}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Routes all records of the root logger through a bounded queue to handlers served by a background thread.
+# burst 0 disables rate limiting. Returns the listener, it is stopped and flushed on exit
+def start(handlers, level=logging.DEBUG, queue_size=10000, burst=5, interval=1.0):
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    if burst > 0:
+        queue_handler.addFilter(RateLimitFilter(burst, interval))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
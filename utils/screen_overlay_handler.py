@@ -6,110 +6,105 @@ from utils.ThreadPool import *
 from utils.tracking import Tracking
 
 import logging
+import time
 
 
-# Used to show tracking box over other screen elements
-class TrackingBox(QSplashScreen):
-    splash_pix = None
-    done = False
+# One transparent, click-through window over the captured screen area that paints all tracking boxes
+class Overlay(QWidget):
+
+    def __init__(self, shared_variables, *args, **kwargs):
+        super(Overlay, self).__init__(*args, **kwargs)
+        self.shared_variables = shared_variables
+
+        # Box image is loaded once and scaled while painting
+        self.box_pix = QPixmap('./docs/box.png')
+        self.label_pen = QPen(QColor(0, 100, 200))
+        self.label_font = QFont()
+        self.label_font.setPointSize(15)
+
+        self.setWindowFlags(Qt.FramelessWindowHint | Qt.WindowStaysOnTopHint | Qt.Tool |
+                            Qt.WindowTransparentForInput)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+        self.setAttribute(Qt.WA_NoSystemBackground)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setAttribute(Qt.WA_ShowWithoutActivating)
+
+        # Covers the captured part of the screen, OFFSET is (top, left)
+        self.setGeometry(self.shared_variables.OFFSET[1], self.shared_variables.OFFSET[0],
+                         self.shared_variables.WIDTH, self.shared_variables.HEIGHT)
+        self.show()
+
+    # Paints every active box with its label
+    def paintEvent(self, event):
+        start = time.perf_counter()
+        painter = QPainter(self)
+        painter.setFont(self.label_font)
+        painter.setPen(self.label_pen)
+
+        for box in list(self.shared_variables.list):  # copy, trackers may remove themselves meanwhile
+            if box.done:
+                continue
+            x, y, width, height = box.screen_rect()
+            painter.drawPixmap(QRect(x, y, width, height), self.box_pix)
+            painter.drawText(x + 30, y + 30, width, height, Qt.TextWordWrap, box.label)
+
+        if self.shared_variables.SHOW_METRICS:
+            painter.drawText(QRect(10, 10, self.width() - 20, self.height() - 20), Qt.AlignLeft | Qt.AlignTop,
+                             "\n".join(self.shared_variables.metrics.summary()))
+
+        painter.end()
+        self.shared_variables.metrics.histogram('overlay_paint_ms').observe(1000 * (time.perf_counter() - start))
+
+
+# Converts a normalized detection box (center x, center y, width, height) to
+# x, y, width, height in pixels of the downscaled frame
+def frame_box(box, shared_variables):
+    frame_width = shared_variables.WIDTH / shared_variables.DETECTION_SCALE
+    frame_height = shared_variables.HEIGHT / shared_variables.DETECTION_SCALE
+    return (int(box[0] * frame_width - (box[2] * frame_width) / 2),
+            int(box[1] * frame_height - (box[3] * frame_height) / 2),
+            int(box[2] * frame_width),
+            int(box[3] * frame_height))
+
+
+# Detected object with its tracking, updated by the tracking engine and painted by the overlay
+class TrackingBox(QObject):
 
     def __init__(self, id, shared_variables, score, classification, box, *args, **kwargs):
         super(TrackingBox, self).__init__(*args, **kwargs)
         self.classification = classification
         self.shared_variables = shared_variables
         self.counter = 0
+        self.misses = 0  # detections in a row that did not confirm this box
 
         # Calculates coordinates and size of the box based on scale
-        self.x = int(box[0] * (self.shared_variables.WIDTH / self.shared_variables.DETECTION_SCALE) - (
-                    box[2] * (self.shared_variables.WIDTH / self.shared_variables.DETECTION_SCALE)) / 2)
-        self.y = int(box[1] * (self.shared_variables.HEIGHT / self.shared_variables.DETECTION_SCALE) - (
-                    box[3] * (self.shared_variables.HEIGHT / self.shared_variables.DETECTION_SCALE)) / 2)
-        self.width = int(box[2] * (self.shared_variables.WIDTH / self.shared_variables.DETECTION_SCALE))
-        self.height = int(box[3] * (self.shared_variables.HEIGHT / self.shared_variables.DETECTION_SCALE))
+        self.x, self.y, self.width, self.height = frame_box(box, self.shared_variables)
         self.id = id
 
-        # Loading and scaling box
-        self.splash_pix = QPixmap('./docs/box.png')
-        self.splash_pix = self.splash_pix.scaled(round(self.width * self.shared_variables.DETECTION_SCALE),
-                                                 round(self.height * self.shared_variables.DETECTION_SCALE))
-        self.setPixmap(self.splash_pix)
-
-        self.setWindowFlag(Qt.WindowStaysOnTopHint)
-        self.setAttribute(Qt.WA_TranslucentBackground)
-        self.setAttribute(Qt.WA_NoSystemBackground)
-
         # Creating a label for detected object with the score and classification
-        label = QLabel(self)
-        label.setWordWrap(True)
-        label.move(30, 30)
-        label.setStyleSheet(" color: rgb(0, 100, 200); font-size: 15pt; ")
-
-        label.setText(str(int(100 * score)) + "%" + " " + classification)
-        self.move(self.x, self.y)
-        self.show()
+        self.label = str(int(100 * score)) + "%" + " " + classification
 
         # Creating tracking object
         self.tracking = Tracking((self.x, self.y, self.width, self.height), self.shared_variables)
 
-        # Initializing thread pool for tracking processing
-        self.threadpool = QThreadPool()
-
-        logging.debug(f"New Box Created at {str(self.x)} {str(self.y)}  Size {str(self.width)} {str(self.height)}")
-
-        self.start_worker()
-
-    # Processing progress
-    def progress_fn(self, n):
-        logging.debug("%d%% done" % n)
-        pass
-
-    # Removes box from tracking box list and stops the thread pool
-    def remove(self):
-        self.shared_variables.list.remove(self)
-        self.done = True
-        self.threadpool.cancel
-
-    # Checks if tracking is still active and executes tracking if so
-    def background_detection(self, progress_callback):
-        if not self.tracking.running:
-            if not self.done:  # Remove self from gui list
-                self.shared_variables.list.remove(self)
-                self.done = True
-                self.threadpool.cancel
-        else:
-            self.tracking.run()
-
-        return "Done."
-
-    # Changes box position and size based on new tracking data
-    def print_output(self, s):
-        self.hide()
-        self.repaint_size(round(self.tracking.box[2] * self.shared_variables.DETECTION_SCALE),
-                          round(self.tracking.box[3] * self.shared_variables.DETECTION_SCALE))
-        self.move(round(self.tracking.box[0] * self.shared_variables.DETECTION_SCALE),
-                  round(self.tracking.box[1] * self.shared_variables.DETECTION_SCALE))
-        self.show()
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(f"New Box Created at {str(self.x)} {str(self.y)}  Size {str(self.width)} {str(self.height)}")
+
+    # Confirms the box with a new detection of the same object
+    def refresh(self, score):
+        self.label = str(int(100 * score)) + "%" + " " + self.classification
+        self.misses = 0
+
+    # Box is done once its tracker lost the object
+    @property
+    def done(self):
+        return not self.tracking.running
 
-    # Starts new thread once old is finished
-    def thread_complete(self):
-        # logging.debug("Thread complete")
-        self.start_worker()
-
-    # Starts new thread for tracking processing
-    def start_worker(self):
-        # Pass the function to execute
-        worker = Worker(self.background_detection)  # Any other args, kwargs are passed to the run function
-        worker.signals.result.connect(self.print_output)
-        worker.signals.finished.connect(self.thread_complete)
-        worker.signals.progress.connect(self.progress_fn)
-
-        # Execute
-        self.threadpool.start(worker)
-
-    # Box scaling
-    def repaint_size(self, width, height):
-        self.splash_pix = self.splash_pix.scaled(width, height)
-        self.setPixmap(self.splash_pix)
+    # Returns box position and size on the screen based on tracking data
+    def screen_rect(self):
+        box = self.tracking.box
+        scale = self.shared_variables.DETECTION_SCALE
+        return round(box[0] * scale), round(box[1] * scale), round(box[2] * scale), round(box[3] * scale)
 
     # Returns box size and coordinates
     def get_box(self):
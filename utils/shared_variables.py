@@ -1,10 +1,12 @@
 """
 This file contains a shared variables class and a mss screen stream capture class
 """
-from mss import mss
-from PIL import Image
 from threading import Thread
 from ml.torch.yolo import YOLO
+from utils.frame_ring import FrameRing
+from utils.capture_source import ScreenSource, ReplaySource, Recorder, BScanRenderer, BScanFileSource, \
+    BScanSocketSource, bscan_shape
+from utils.metrics import MetricsRegistry
 
 import numpy as np
 import cv2
@@ -16,6 +18,8 @@ import logging
 # an instance of this class share variables between system threads
 class SharedVariables:
     model = YOLO
+    MODEL_BACKEND = 'torch'  # 'torch', 'onnx', 'onnx-int8' or 'openvino'
+    INFERENCE_THREADS = 0  # intra-op threads of the onnx/openvino backends, 0 - runtime default
 
     tracking_boxes = []
     _initialized = 0
@@ -23,7 +27,11 @@ class SharedVariables:
     WIDTH, HEIGHT = 1920, 1080  # 2560, 1440
     detection_ready = False
     category_index = None
-    OutputFrame = None
+    frame_ring = None  # captured frames, read them with frame_ring.read_latest()
+    detection_scheduler = None
+    overlay = None
+    metrics = None  # MetricsRegistry of this process
+    DETECT_ON_TRACKING_LOSS = True
     frame = None
     boxes = None
     category_list = []
@@ -34,10 +42,36 @@ class SharedVariables:
     DETECTION_SIZE = 640
     DETECTION_SCALE = 0
     RED_NUMBER = 240
+    ZERO_COPY_CAPTURE = True  # view mss buffer directly instead of the PIL round-trip
+    CAPTURE_BUFFERS = 3  # reusable frames in the frame ring
+    CAPTURE_FPS = 30  # upper bound on captured frames per second
+    TILED_DETECTION = False  # detect on full resolution tiles instead of a downscaled frame
+    TILE_SIZE = 640
+    TILE_OVERLAP = 0.2  # overlap of neighbouring tiles as a fraction of TILE_SIZE
+    TILE_NMS_IOU = 0.5  # boxes from different tiles overlapping more than this are merged
+    CHANGE_THRESHOLD = 4  # block colour difference that counts as a screen change, 0 - always run inference
+    METRICS_FILE = None  # JSON lines file the metrics are appended to, None - no file
+    METRICS_INTERVAL = 5  # seconds between metrics reports
+    SHOW_METRICS = False  # paint the metrics summary in the overlay
+    RECORD_FILE = None  # record captured frames to this file, None - no recording
+    REPLAY_FILE = None  # replay a recording instead of capturing the screen
+    REPLAY_SPEED = 1.0  # 1 - recorded pace, 2 - twice as fast, 0 - as fast as possible
+    REPLAY_LOOP = False  # start the recording over when it ends, also for sequences of B-scans
+    BSCAN_SOURCE = None  # raw B-scans instead of the screen: a .npy file or "tcp://host:port", None - screen
+    BSCAN_RANGE = None  # (min, max) B-scan values of the colour scale, None - min and max of every B-scan
 
-    def __init__(self):
+    # start_capture - False when capture starts later with start_streamer(), or runs in another process
+    # and frame_ring is replaced from outside
+    def __init__(self, start_capture=True):
         Thread.__init__(self)
         self._initialized = 1
+        self.metrics = MetricsRegistry()
+        self.frame_ring = FrameRing(self.CAPTURE_BUFFERS)
+        if start_capture:
+            self.start_streamer()
+
+    # Starts the screen capture thread
+    def start_streamer(self):
         ScreenStreamer(shared_variables=self).start()
 
 
@@ -46,33 +80,129 @@ class ScreenStreamer(Thread):
         Thread.__init__(self)
         self.shared_variables = shared_variables
 
+        # Reusable buffer for the zero-copy capture path
+        self.resized = None
+
     # Performs downscaling
     def downscale(self, image):
         scale = None
         image_size_threshold = self.shared_variables.DETECTION_SIZE
         height, width, channel = image.shape
 
-        if height > image_size_threshold:
+        if self.shared_variables.TILED_DETECTION:
+            # Tiled detection works on the full resolution frame
+            scale = 1.0
+        elif height > image_size_threshold:
             scale = height / image_size_threshold
 
             image = cv2.resize(image, (int(width / scale), int(height / scale)))
 
         return image, scale
 
-    # Performs screen capture
-    def run(self):
-        sct = mss()
+    # Views the BGRA buffer of a mss screenshot as a numpy array without copying it
+    @staticmethod
+    def view_bgra(screenshot):
+        return np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(screenshot.height, screenshot.width, 4)
+
+    # Performs downscaling and BGRA -> RGB conversion into preallocated buffers
+    def downscale_into(self, bgra):
+        scale = None
+        image_size_threshold = self.shared_variables.DETECTION_SIZE
+        height, width, channel = bgra.shape
+
+        if self.shared_variables.TILED_DETECTION:
+            # Tiled detection works on the full resolution frame
+            scale = 1.0
+        elif height > image_size_threshold:
+            scale = height / image_size_threshold
+            size = (int(width / scale), int(height / scale))
+
+            if self.resized is None or self.resized.shape[:2] != (size[1], size[0]):
+                self.resized = np.empty((size[1], size[0], 4), dtype=np.uint8)
+
+            # Resizing before the colour conversion keeps the conversion on the small frame
+            cv2.resize(bgra, size, dst=self.resized)
+            bgra = self.resized
+
+        output = self.shared_variables.frame_ring.acquire((bgra.shape[0], bgra.shape[1], 3))
+        cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGB, dst=output)
+
+        return output, scale
+
+    # Grabs one frame from the screen and returns it downscaled in RGB
+    def capture(self, sct, monitor):
+        if self.shared_variables.ZERO_COPY_CAPTURE:
+            return self.downscale_into(self.view_bgra(sct.grab(monitor)))
+
+        from PIL import Image  # only used by the legacy capture
+
+        img = Image.frombytes('RGB', (self.shared_variables.WIDTH, self.shared_variables.HEIGHT),
+                              sct.grab(monitor).rgb)
+        image, scale = self.downscale(np.array(img))
+        output = self.shared_variables.frame_ring.acquire(image.shape)
+        np.copyto(output, image)
+        return output, scale
+
+    # Returns the frame source, the screen, a recording or raw B-scans
+    def create_source(self):
+        if self.shared_variables.BSCAN_SOURCE is not None:
+            return self.create_bscan_source()
+
+        if self.shared_variables.REPLAY_FILE is not None:
+            return ReplaySource(self.shared_variables.REPLAY_FILE, self.shared_variables.frame_ring,
+                                self.shared_variables.REPLAY_SPEED, self.shared_variables.REPLAY_LOOP)
+
         monitor = {'top': self.shared_variables.OFFSET[0], 'left': self.shared_variables.OFFSET[1],
                    'width': self.shared_variables.WIDTH, 'height': self.shared_variables.HEIGHT}
-        logging.info(f"MSS started with monitor : {monitor}")
-
-        while self.shared_variables.stream_running:
-            if self.shared_variables.detection_ready:
-                img = Image.frombytes('RGB', (self.shared_variables.WIDTH, self.shared_variables.HEIGHT),
-                                      sct.grab(monitor).rgb)
-                self.shared_variables.OutputFrame, self.shared_variables.DETECTION_SCALE = self.downscale(np.array(img))
-                if cv2.waitKey(25) & 0xFF == ord('q'):
-                    cv2.destroyAllWindows()
-                    break
-            else:
-                time.sleep(0.1)
+        return ScreenSource(self.capture, monitor, self.shared_variables.CAPTURE_FPS)
+
+    # B-scans are rendered straight into frames of DETECTION_SIZE, there is no capture and no resize
+    def create_bscan_source(self):
+        shared_variables = self.shared_variables
+        shape = bscan_shape(shared_variables.WIDTH, shared_variables.HEIGHT, shared_variables.DETECTION_SIZE)
+        renderer = BScanRenderer(shared_variables.frame_ring, shape,
+                                 shared_variables.HEIGHT / shared_variables.DETECTION_SIZE,
+                                 shared_variables.BSCAN_RANGE)
+
+        source = str(shared_variables.BSCAN_SOURCE)
+        if source.startswith('tcp://'):
+            host, port = source[len('tcp://'):].rsplit(':', 1)
+            return BScanSocketSource((host, int(port)), renderer, lambda: shared_variables.stream_running)
+        return BScanFileSource(source, renderer, shared_variables.CAPTURE_FPS, shared_variables.REPLAY_LOOP)
+
+    # Performs screen capture
+    def run(self):
+        frame_ring = self.shared_variables.frame_ring
+        frames = None
+        recorder = None
+
+        try:
+            while self.shared_variables.stream_running:
+                if self.shared_variables.detection_ready:
+                    # Settings are complete once detection is ready
+                    if frames is None:
+                        frames = self.create_source().frames()
+                        if self.shared_variables.RECORD_FILE is not None:
+                            recorder = Recorder(self.shared_variables.RECORD_FILE)
+
+                    frame = next(frames, None)
+                    if frame is None:
+                        logging.info("Frame source finished")
+                        break
+
+                    image, scale, timestamp = frame
+                    if recorder is not None:
+                        recorder.write(image, scale, timestamp)
+                    self.shared_variables.DETECTION_SCALE = scale
+                    frame_ring.publish(image, scale, timestamp)
+                    self.shared_variables.metrics.rate('capture_fps').mark()
+                    # Only the screen capture polls keys, it needs a GUI build of OpenCV that headless machines lack
+                    if self.shared_variables.REPLAY_FILE is None and self.shared_variables.BSCAN_SOURCE is None \
+                            and cv2.waitKey(25) & 0xFF == ord('q'):
+                        cv2.destroyAllWindows()
+                        break
+                else:
+                    time.sleep(0.1)
+        finally:
+            if recorder is not None:
+                recorder.close()
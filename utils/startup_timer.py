@@ -0,0 +1,50 @@
+"""
+This file contains a timer that records startup phases and logs a timing breakdown
+"""
+
+from contextlib import contextmanager
+from threading import Lock
+
+import time
+import logging
+
+
+# Records phases (with duration) and marks (points in time) relative to program start.
+# Phases may run in parallel threads, the report orders them by start time
+class StartupTimer:
+
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.records = []  # (name, start offset, duration or None)
+        self.lock = Lock()
+        self.reported = False
+
+    # Times the enclosed block as a phase
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.records.append((name, start - self.start, time.perf_counter() - start))
+
+    # Records a point in time, for example the first detection
+    def mark(self, name):
+        with self.lock:
+            self.records.append((name, time.perf_counter() - self.start, None))
+
+    # Logs all phases and marks once
+    def report(self):
+        with self.lock:
+            if self.reported:
+                return
+            self.reported = True
+            records = sorted(self.records, key=lambda record: record[1])
+
+        logging.info("----- Startup timing -----")
+        for name, offset, duration in records:
+            if duration is None:
+                logging.info(f"{name:<28} at {1000 * offset:8.0f} ms")
+            else:
+                logging.info(f"{name:<28} at {1000 * offset:8.0f} ms  took {1000 * duration:8.0f} ms")
@@ -2,9 +2,15 @@
 This file realizes object tracking in videostream using OpenCV and Kalman filter
 """
 
-import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from utils.kalman import BatchKalman
+
 import cv2
 
+FRAME_TIMEOUT = 0.1  # seconds to wait for a new frame before giving control back
+
 
 # Realize tracking of single object
 class Tracking:
@@ -19,36 +25,23 @@ class Tracking:
     end_time = None  # tracking enc time
     first_time = True  # flag
     first = True  # flag
+    kalman_index = None  # slot in the batched Kalman filter of MultiTracking
+    measurement = None  # tracker box waiting for the batched Kalman step
+    key = None  # identifies the tracking between the GUI and the tracking process
 
     # Initiate thread
     def __init__(self, box, shared_variables):
         self.box = box  # starting coordinates and size
         self.shared_variables = shared_variables
 
-        # Kalman filter init
-        self.kalman = cv2.KalmanFilter(4, 2, 0)
-        self.kalman.measurementMatrix = np.array([[1, 0, 0, 0],
-                                                  [0, 1, 0, 0]], np.float32)
-
-        self.kalman.transitionMatrix = np.array([[1, 0, 1, 0],
-                                                 [0, 1, 0, 1],
-                                                 [0, 0, 1, 0],
-                                                 [0, 0, 0, 1]], np.float32)
-
-        self.kalman.processNoiseCov = np.array([[1, 0, 0, 0],
-                                                [0, 1, 0, 0],
-                                                [0, 0, 1, 0],
-                                                [0, 0, 0, 1]], np.float32) * 0.03
+    # Tracks the object on a frame
+    def track(self, frame):
+        self.frame = frame  # updates current frame
 
-    # Thread run function
-    def run(self):
-        self.frame = self.shared_variables.OutputFrame  # updates current frame
-
-        if self.frame is not None:
-            if self.first_time:  # if first time, initializes tracker
-                self.update_custom_tracker()
-                self.first_time = False
-            self.object_custom_tracking()  # performs tracking
+        if self.first_time:  # if first time, initializes tracker
+            self.update_custom_tracker()
+            self.first_time = False
+        self.object_custom_tracking()  # performs tracking
 
     # Create_custom_tracker
     def create_custom_tracker(self):
@@ -60,7 +53,7 @@ class Tracking:
     # Set and reset custom tracker. Initializes tracker on current frame
     def update_custom_tracker(self):
         self.create_custom_tracker()
-        print(self.frame.shape, self.box)
+        self.shared_variables.metrics.rate('tracker_inits').mark()
         self.tracker_test = self.tracker.init(self.frame, self.box)
 
     def get_box(self):
@@ -72,79 +65,122 @@ class Tracking:
 
         # Update tracker box
         if self.tracker_test:
-            if self.first:
-                A = self.kalman.statePost
-                A[0:4] = np.array([[np.float32(box[0])], [np.float32(box[1])], [0], [0]])
-                self.kalman.statePost = A
-                self.kalman.statePre = A
-                self.first = False
-
-            current_measurement = np.array([[np.float32(box[0])], [np.float32(box[1])]])
-            self.kalman.correct(current_measurement)  # correcting tracking results
-            prediction = self.kalman.predict()
-            self.box = [int(prediction[0]), int(prediction[1]), box[2], box[3]]
+            self.measurement = box  # MultiTracking corrects all objects at once
             self.fail_counter = 0
         else:  # if tracking fails
             self.fail_counter += 1  # increase fail counter
+            if self.shared_variables.DETECT_ON_TRACKING_LOSS and self.shared_variables.detection_scheduler is not None:
+                self.shared_variables.detection_scheduler.trigger()  # look for the object again right away
             if self.fail_counter > self.shared_variables.MAX_TRACKING_MISSES:  # misses reached maximum amount
                 self.running = False  # aborting tracking
 
 
-# Realize tracking of multiple objects
+# Realize tracking of multiple objects. Owns all Tracking instances and updates them once per new frame,
+# in this thread or over a bounded worker pool, then publishes all boxes together
 class MultiTracking:
-    tracker_test = None  # result
-    tracker = None  # OpenCV tracker
-    frame = None  # current frame
     running = True  # status
+    sequence = 0  # sequence number of the last tracked frame
 
-    fail_counter = 0
+    def __init__(self, shared_variables, workers=0):
+        self.shared_variables = shared_variables
+        self.trackings = []  # active trackings
+        self.pending = []  # trackings added since the last frame
+        self.refreshed = []  # (tracking, box) pairs confirmed by a new detection
+        self.lock = Lock()
+        self.kalman = BatchKalman()  # one filter for all objects
+
+        # OpenCV trackers release the GIL, so a few threads can share the work
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    # Adds a tracking, it is initialized on the next frame
+    def add_tracker(self, tracking):
+        with self.lock:
+            self.pending.append(tracking)
+
+    # Restarts a tracking on a new detection box on the next frame
+    def refresh_tracker(self, tracking, box):
+        with self.lock:
+            self.refreshed.append((tracking, box))
+
+    # Updates all trackings on one frame, drops the lost ones and returns the active ones
+    def update(self, frame):
+        with self.shared_variables.metrics.timer('tracker_update_ms'):
+            trackings = self.update_trackings(frame)
+        self.shared_variables.metrics.gauge('active_tracks').set(len(trackings))
+        return trackings
+
+    # Applies new and refreshed trackings, tracks all of them and corrects the boxes
+    def update_trackings(self, frame):
+        with self.lock:
+            for tracking, box in self.refreshed:
+                tracking.box = box
+                tracking.first_time = True  # reinitialize the OpenCV tracker
+                tracking.first = True  # restart the Kalman filter
+                tracking.fail_counter = 0
+            self.refreshed.clear()
+            for tracking in self.pending:
+                tracking.kalman_index = self.kalman.add()
+            self.trackings.extend(self.pending)
+            self.pending.clear()
+
+        if self.pool is not None and len(self.trackings) > 1:
+            list(self.pool.map(lambda tracking: tracking.track(frame), self.trackings))
+        else:
+            for tracking in self.trackings:
+                tracking.track(frame)
 
-    start_time = None  # tracking start time
-    end_time = None  # tracking enc time
-    first_time = True  # flag
-    first = True  # flag
+        self.correct_boxes()
 
-    def __init__(self, box, shared_variables):
-        self.box = box
-        self.shared_variables = shared_variables
+        # Release Kalman slots of lost objects
+        for tracking in self.trackings:
+            if not tracking.running:
+                self.kalman.remove(tracking.kalman_index)
 
-    def run(self):
-        self.frame = self.shared_variables.OutputFrame
+        self.trackings = [tracking for tracking in self.trackings if tracking.running]
+        return self.trackings
 
-        if self.frame is not None:
-            if self.first_time:
-                self.update_custom_tracker()
-                self.first_time = False
-            self.object_custom_tracking()
+    # Runs one vectorized Kalman step for all objects the trackers found on this frame
+    def correct_boxes(self):
+        measured = [tracking for tracking in self.trackings if tracking.measurement is not None]
+        if len(measured) == 0:
+            return
 
-    def create_custom_tracker(self):
-        self.Tracker = cv2.legacy.MultiTracker.create()
+        for tracking in measured:
+            if tracking.first:  # start from the first tracked position
+                self.kalman.reset(tracking.kalman_index, tracking.measurement[0], tracking.measurement[1])
+                tracking.first = False
 
-    def update_custom_tracker(self):
-        self.create_custom_tracker()
-        print(self.frame.shape, self.box)
-        self.tracker_test = self.tracker.init(self.frame, self.box)
+        predictions = self.kalman.step([tracking.kalman_index for tracking in measured],
+                                       [tracking.measurement[:2] for tracking in measured])
 
-    def get_box(self):
-        return self.box
+        for tracking, prediction in zip(measured, predictions):
+            tracking.box = [int(prediction[0]), int(prediction[1]), tracking.measurement[2], tracking.measurement[3]]
+            tracking.measurement = None
 
-    # def add_tracker(self, frame, box):
-    def add_tracker(self, frame, bboxes):
-        # Initialize MultiTracker
-        for bbox in bboxes:
-            # self.tracker.add(cv2.legacy.TrackerCSRT.create(), frame, bbox)
-            # self.tracker.add(cv2.legacy.TrackerKCF.create(), frame, bbox)
-            self.tracker.add(cv2.legacy.TrackerMOSSE.create(), frame, bbox)
+    # Tracking loop, waits for each new frame and emits the updated trackings once per frame
+    def run(self, progress_callback):
+        while self.running and self.shared_variables.stream_running:
+            with self.shared_variables.frame_ring.read_newer(self.sequence, FRAME_TIMEOUT) as frame:
+                if frame is None:
+                    continue
+                self.sequence = frame.sequence
 
-    def object_custom_tracking(self):
-        # Calculate
-        self.tracker_test, box = self.tracker.update(self.frame)
+                # Nothing to track, nothing to publish
+                if len(self.trackings) == 0 and len(self.pending) == 0 and len(self.refreshed) == 0:
+                    continue
 
-        # Update tracker box
-        if self.tracker_test:
-            self.box = box
-            self.fail_counter = 0
-        else:
-            self.fail_counter += 1
-            if self.fail_counter > self.shared_variables.MAX_TRACKING_MISSES:  # misses reached maximum amount
-                self.running = False  # abort tracking
+                trackings = list(self.update(frame.image))
+
+            progress_callback.emit(trackings)
+
+        if self.pool is not None:
+            self.pool.shutdown()
+        return "Done."
+
+    # Stops tracking an object, it is dropped on the next frame
+    def remove_tracker(self, tracking):
+        tracking.running = False
+
+    # Stops the tracking loop
+    def stop(self):
+        self.running = False